@@ -5,14 +5,23 @@ import os
 import glob
 import datetime
 from dateutil.parser import isoparse
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 import math
+import sys
+import argparse
+import functools
+import logging
 
 # --- Configuration ---
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 RAW_DATA_DIR = os.path.join(PROJECT_ROOT, "raw_data")
 TEMPLATES_DIR = os.path.join(PROJECT_ROOT, "templates")
-OUTPUT_HTML_FILE = os.path.join(PROJECT_ROOT, "output_report.html")
+JINJA_CACHE_DIR = os.path.join(PROJECT_ROOT, ".jinja_cache") # Compiled template bytecode, shared with main.py
+OUTPUT_HTML_FILE = os.path.join(PROJECT_ROOT, "output_report.html") # When no client ID is given
+
+def output_html_file(client_id=None):
+    # One report per client, so a queued job for another client can't overwrite a report still being viewed/sent
+    return os.path.join(PROJECT_ROOT, f"output_report_{client_id}.html") if client_id is not None else OUTPUT_HTML_FILE
 
 SLA_DEFINITIONS = {
     "Urgent": {"reply": 30 * 60, "resolve": 7 * 24 * 60 * 60},
@@ -24,9 +33,11 @@ SLA_DEFINITIONS = {
 CHART_COLORS = ['#007bff', '#28a745', '#ffc107', '#dc3545', '#6f42c1', '#fd7e14', '#20c997', '#6610f2', '#e83e8c']
 
 
-def log_message(message, level="INFO"):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] [{level}] [build_report] {message}")
+logger = logging.getLogger("build_report")
+
+def log_message(message, *args, level="INFO"):
+    # In-process runs go through main.py's queue handler; the CLI configures its own below
+    logger.log(logging.getLevelName(level), message, *args)
 
 def format_datetime_filter(value, format_string="%b %d, %Y %H:%M"):
     if not value: return "N/A"
@@ -136,26 +147,30 @@ def generate_sla_bar_chart_html(met_count, applicable_count, chart_title, met_co
     """
 
 # --- Data Loading Functions --- (Keep as is)
-def find_client_data_file(raw_data_path): # ...
-    log_message(f"Searching for client data files in: {raw_data_path}")
+def find_client_data_file(raw_data_path, client_id=None): # ...
+    if client_id is not None:
+        client_file = os.path.join(raw_data_path, f"freshservice_{client_id}.json")
+        if os.path.exists(client_file): log_message("Using client data file: %s", client_file); return client_file
+        log_message("No data file for client %s at %s.", client_id, client_file, level="ERROR"); return None
+    log_message("Searching for client data files in: %s", raw_data_path)
     search_pattern = os.path.join(raw_data_path, "freshservice_*.json")
     files = glob.glob(search_pattern)
-    if not files: log_message("No client data files found.", "ERROR"); return None
+    if not files: log_message("No client data files found.", level="ERROR"); return None
     files.sort(key=os.path.getmtime, reverse=True)
-    log_message(f"Using newest file: {files[0]}")
+    log_message("Using newest file: %s", files[0])
     return files[0]
 
 def load_client_data(file_path): # ...
-    log_message(f"Loading client data from: {file_path}")
+    log_message("Loading client data from: %s", file_path)
     try:
         with open(file_path, 'r', encoding='utf-8') as f: data = json.load(f)
         log_message("Client data loaded successfully.")
         return data
-    except Exception as e: log_message(f"Error loading {file_path}: {e}", "ERROR"); return None
+    except Exception as e: log_message("Error loading %s: %s", file_path, e, level="ERROR"); return None
 
 # --- Stats Calculation ---
 def calculate_ticket_stats(tickets_data):
-    log_message(f"Calculating stats for {len(tickets_data)} tickets.")
+    log_message("Calculating stats for %s tickets.", len(tickets_data))
     if not tickets_data: return {}
     stats = { # (Initialize stats dict as before)
         "total_tickets": len(tickets_data), "closed_tickets": 0, "open_tickets": 0,
@@ -212,52 +227,34 @@ def calculate_ticket_stats(tickets_data):
     stats['fr_sla_chart_html'] = generate_sla_bar_chart_html(stats['first_reply_sla_met'], stats['first_reply_sla_applicable'], 'First Reply SLA Met/Missed')
     stats['res_sla_chart_html'] = generate_sla_bar_chart_html(stats['resolution_sla_met'], stats['resolution_sla_applicable'], 'Resolution SLA Met/Missed')
 
-    log_message(f"Stats calculated and HTML charts generated.")
+    log_message("Stats calculated and HTML charts generated.")
     return stats
 
 # --- HTML Rendering --- (No changes needed to this function itself)
-def render_html_report(client_info, tickets_data, calculated_stats):
-    log_message("Rendering HTML report with HTML charts...")
-    env = Environment(loader=FileSystemLoader(TEMPLATES_DIR), autoescape=True)
+@functools.lru_cache(maxsize=1)
+def get_report_environment():
+    # One environment per process: compiled templates stay in its cache between reports (auto_reload still picks up
+    # edits), and the bytecode cache skips recompiling across restarts
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    env = Environment(loader=FileSystemLoader(TEMPLATES_DIR), autoescape=True, bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR))
     env.filters['format_duration'] = format_duration; env.filters['format_datetime'] = format_datetime_filter
     env.filters['format_date'] = format_date_filter; env.filters['get_satisfaction_text'] = get_satisfaction_text
+    return env
+
+def render_html_report(client_info, tickets_data, calculated_stats):
+    log_message("Rendering HTML report with HTML charts...")
+    env = get_report_environment()
     template_name = 'email_report_template.html'
     try: template = env.get_template(template_name)
-    except Exception as e: log_message(f"Error loading template: {e}", "ERROR"); return "Error loading template."
+    except Exception as e: log_message("Error loading template: %s", e, level="ERROR"); return None
     report_data = {"client_info": client_info, "tickets": tickets_data, "stats": calculated_stats,
                    "generation_date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
     html_output = template.render(report_data)
     log_message("HTML report rendered successfully.")
     return html_output
 
-# --- Main Logic --- (No changes needed here)
-def main(): # ... (as before)
-    log_message("Starting report generation process...")
-    client_data_file = find_client_data_file(RAW_DATA_DIR)
-    if not client_data_file: return
-    data = load_client_data(client_data_file)
-    if not data: return
-    client_info = data.get('client_info', {})
-    tickets_data = data.get('tickets', [])
-    log_message(f"Processing report for: {client_info.get('name')} (ID: {client_info.get('id')})")
-    calculated_stats = calculate_ticket_stats(tickets_data)
-    html_content = render_html_report(client_info, tickets_data, calculated_stats)
-    if html_content:
-        try:
-            with open(OUTPUT_HTML_FILE, 'w', encoding='utf-8') as f: f.write(html_content)
-            log_message(f"HTML report saved to: {OUTPUT_HTML_FILE}")
-        except Exception as e: log_message(f"Error saving HTML: {e}", "ERROR")
-    log_message("Report generation process finished.")
-
-
-if __name__ == "__main__":
-    if not os.path.exists(TEMPLATES_DIR):
-        os.makedirs(TEMPLATES_DIR); log_message(f"Created: {TEMPLATES_DIR}")
-    default_template_path = os.path.join(TEMPLATES_DIR, "email_report_template.html")
-    log_message(f"Ensuring default template at '{default_template_path}'.")
-
-    # --- TEMPLATE V8 (for HTML segmented bar charts) ---
-    basic_template_content = """
+# --- TEMPLATE V8 (for HTML segmented bar charts) ---
+DEFAULT_TEMPLATE_CONTENT = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -344,17 +341,54 @@ if __name__ == "__main__":
 </td></tr></table>
 </body></html>
 """
-    # --- END TEMPLATE V8 ---
+# --- END TEMPLATE V8 ---
 
+def ensure_default_template():
+    if not os.path.exists(TEMPLATES_DIR):
+        os.makedirs(TEMPLATES_DIR); log_message("Created: %s", TEMPLATES_DIR)
+    default_template_path = os.path.join(TEMPLATES_DIR, "email_report_template.html")
+    log_message("Ensuring default template at '%s'.", default_template_path)
     write_template = True
     if os.path.exists(default_template_path):
         try:
             with open(default_template_path, 'r', encoding='utf-8') as f_read:
-                if f_read.read() == basic_template_content: write_template = False
-        except Exception as e: log_message(f"Error reading template: {e}", "WARNING")
+                if f_read.read() == DEFAULT_TEMPLATE_CONTENT: write_template = False
+        except Exception as e: log_message("Error reading template: %s", e, level="WARNING")
     if write_template:
-        with open(default_template_path, 'w', encoding='utf-8') as f_template: f_template.write(basic_template_content)
-        log_message(f"Created/Updated default template at '{default_template_path}'")
-    else: log_message(f"Default template '{default_template_path}' is up-to-date.")
+        with open(default_template_path, 'w', encoding='utf-8') as f_template: f_template.write(DEFAULT_TEMPLATE_CONTENT)
+        log_message("Created/Updated default template at '%s'", default_template_path)
+    else: log_message("Default template '%s' is up-to-date.", default_template_path)
 
-    main()
+# --- Main Logic ---
+def main(client_id=None): # Returns (success, message) so main.py can call this in-process
+    log_message("Starting report generation process...")
+    ensure_default_template()
+    client_data_file = find_client_data_file(RAW_DATA_DIR, client_id)
+    if not client_data_file: return False, "No client data file found in raw_data."
+    data = load_client_data(client_data_file)
+    if not data: return False, f"Could not load {client_data_file}."
+    client_info = data.get('client_info', {})
+    tickets_data = data.get('tickets', [])
+    log_message("Processing report for: %s (ID: %s)", client_info.get('name'), client_info.get('id'))
+    calculated_stats = calculate_ticket_stats(tickets_data)
+    html_content = render_html_report(client_info, tickets_data, calculated_stats)
+    if not html_content: return False, "Error rendering the report template."
+    output_file = output_html_file(client_id)
+    try:
+        with open(output_file, 'w', encoding='utf-8') as f: f.write(html_content)
+        log_message("HTML report saved to: %s", output_file)
+    except Exception as e:
+        log_message("Error saving HTML: %s", e, level="ERROR"); return False, f"Error saving HTML: {e}"
+    log_message("Report generation process finished.")
+    return True, f"Report saved to {output_file}."
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the HTML report from Freshservice data in raw_data/.")
+    parser.add_argument("client_id", nargs="?", help="Client ID whose data file to use (default: newest file).")
+    args = parser.parse_args()
+    logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S",
+                        level=logging.INFO, stream=sys.stdout)
+    success, message = main(args.client_id)
+    if not success: log_message(message, level="ERROR")
+    sys.exit(0 if success else 1)
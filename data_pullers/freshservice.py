@@ -1,14 +1,25 @@
 # integoreport/data_pullers/freshservice.py
 
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import functools
 import json
 import os
 import sys
+import tempfile
 import time
 import datetime
 from dateutil.relativedelta import relativedelta # For easy month calculation
 import argparse # For command-line arguments
+import logging
+import logging.handlers
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson # Optional; speeds up parsing API responses and writing the per-ticket NDJSON lines
+except ImportError:
+    orjson = None
 
 # --- Configuration ---
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # integoreport/
@@ -17,80 +28,175 @@ FRESHSERVICE_DOMAIN = "integotecllc.freshservice.com"
 BASE_URL = f"https://{FRESHSERVICE_DOMAIN}"
 OUTPUT_DIR = os.path.join(PROJECT_ROOT, "raw_data")
 
-ITEMS_PER_PAGE = 30
-TICKETS_PER_PAGE = 30 # For the initial list call
+ITEMS_PER_PAGE = 100 # Freshservice v2 maximum for conversations, time entries and other sub-resource lists
+TICKETS_PER_PAGE = 30 # For the initial list call; the ticket filter endpoint pages at 30
 MAX_RETRIES = 3
-RETRY_DELAY = 5
+RETRY_DELAY = 5 # Base delay in seconds; doubled on each retry of a transient failure
 REQUEST_TIMEOUT = 30
 DELAY_BETWEEN_TICKET_PROCESSING_CALLS = 0.25 # Small delay between processing each ticket from the list
 DELAY_BETWEEN_SUB_RESOURCE_CALLS = 0.1 # Smaller delay for conversations, time entries etc. for a single ticket
-
-def log_message(message, is_error=False):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    formatted_message = f"[{timestamp}] [freshservice_explorer] {message}"
-    stream = sys.stderr if is_error else sys.stdout
-    print(formatted_message, file=stream)
+RATEABLE_STATUS_IDS = (4, 5) # Resolved, Closed; satisfaction ratings only exist for these
+MAX_SUB_RESOURCE_PAGES = 100
+MAX_PAGE_BURST = 8 # Upper bound on concurrent page requests for one sub-resource
+INCLUDED_CONVERSATIONS_LIMIT = 10 # Freshservice returns at most this many conversations via ?include=conversations
+_TZ_UTC = datetime.timezone.utc
+
+logger = logging.getLogger("freshservice_explorer")
+
+def configure_logging(level=logging.INFO, log_file=None):
+    # Info goes to stdout and errors to stderr, matching what main.py's script runner expects
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.ERROR)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.ERROR)
+    handlers = [stdout_handler, stderr_handler]
+    if log_file: handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=1_000_000, backupCount=3, encoding='utf-8'))
+    logging.basicConfig(format="[%(asctime)s] [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S",
+                        level=level, handlers=handlers)
+
+def log_message(message, *args, is_error=False):
+    # Arguments are %-formatted lazily by logging, only if the record is actually emitted
+    logger.log(logging.ERROR if is_error else logging.INFO, message, *args)
 
 def read_api_key(file_path):
     try:
         abs_file_path = os.path.abspath(file_path)
-        log_message(f"Attempting to read token from: {abs_file_path}")
+        log_message("Attempting to read token from: %s", abs_file_path)
         if not os.path.exists(abs_file_path):
-            log_message(f"Error: Token file '{abs_file_path}' not found.", is_error=True)
-            sys.exit(1)
+            log_message("Error: Token file '%s' not found.", abs_file_path, is_error=True)
+            return None
         with open(abs_file_path, 'r') as f:
             api_key = f.read().strip()
         if not api_key:
-            log_message(f"Error: Token file '{abs_file_path}' is empty.", is_error=True)
-            sys.exit(1)
+            log_message("Error: Token file '%s' is empty.", abs_file_path, is_error=True)
+            return None
         return api_key
     except Exception as e:
-        log_message(f"Error reading token file '{abs_file_path}': {e}", is_error=True)
-        sys.exit(1)
-
-def make_api_request(url, headers, params=None, method="GET", retries=MAX_RETRIES, delay=RETRY_DELAY, allow_404=False, allow_403=False):
+        log_message("Error reading token file '%s': %s", abs_file_path, e, is_error=True)
+        return None
+
+@functools.lru_cache(maxsize=1)
+def build_headers(api_key):
+    # Built once per API key (the in-process app calls main() for every report; a rotated token.txt just misses
+    # the cache); the read-only mapping is shared by reference across every request
+    auth_header = f"Basic {base64.b64encode(f'{api_key}:X'.encode()).decode()}"
+    return MappingProxyType({"Content-Type": "application/json", "Authorization": auth_header})
+
+# orjson when installed, stdlib json otherwise; orjson.JSONDecodeError subclasses json.JSONDecodeError
+def decode_json(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def build_http_session():
+    # One pooled session for the whole pull; sized for the concurrent sub-resource page bursts
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=MAX_PAGE_BURST * 2, max_retries=0))
+    return session
+
+HTTP_SESSION = build_http_session()
+
+# --- Conditional GET cache ---
+# Maps "url?params" -> {"etag": ..., "body": ...} so reruns can send If-None-Match and reuse the body on a 304.
+# Only the ticket filter pages opt in (use_etag=True): they repeat across runs for the same client and period,
+# while ticket details and their sub-resource pages stay streamed through memory one ticket at a time.
+# One file per client and period; emptied from memory as soon as the pull ends.
+etag_cache = {}
+etag_touched = set() # Keys requested during the current run; only these are written back
+etag_supported = None # Unknown until the first response of each pull shows whether Freshservice sends ETags
+
+def etag_cache_file(client_id):
+    return os.path.join(OUTPUT_DIR, f".freshservice_etags_{client_id}.json")
+
+def etag_cache_key(url, params):
+    if not params: return url
+    return url + "?" + "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+
+def load_etag_cache(client_id, period_start):
+    global etag_supported
+    etag_cache.clear(); etag_touched.clear(); etag_supported = None # Re-probed per pull, not once per process
+    cache_file = etag_cache_file(client_id)
+    if not os.path.exists(cache_file): return
+    try:
+        with open(cache_file, 'rb') as f: saved = decode_json(f.read())
+        if saved.get("period_start") != period_start: return # Last month's responses can't be asked for again
+        etag_cache.update(saved.get("entries", {}))
+        log_message("Loaded %s cached responses from %s", len(etag_cache), cache_file)
+    except (IOError, json.JSONDecodeError, AttributeError) as e:
+        log_message("Ignoring unreadable ETag cache %s: %s", cache_file, e, is_error=True)
+
+def save_etag_cache(client_id, period_start):
+    entries = {key: etag_cache[key] for key in etag_touched if key in etag_cache}
+    etag_cache.clear(); etag_touched.clear() # Nothing outlives the pull inside the long-running app
+    if not etag_supported: return
+    saved = {"period_start": period_start, "entries": entries}
+    try:
+        # Written to a temp file and swapped in, so an interrupted save can't leave a truncated cache behind
+        with tempfile.NamedTemporaryFile('wb', dir=OUTPUT_DIR, prefix=".freshservice_etags.", suffix=".tmp", delete=False) as f:
+            f.write(orjson.dumps(saved) if orjson else json.dumps(saved).encode("utf-8"))
+        os.replace(f.name, etag_cache_file(client_id))
+    except IOError as e:
+        if 'f' in locals() and os.path.exists(f.name): os.remove(f.name)
+        log_message("Could not write ETag cache for client %s: %s", client_id, e, is_error=True)
+
+def remember_etag(cache_key, response, body):
+    global etag_supported
+    etag = response.headers.get("ETag") or (response.status_code == 304 and etag_cache.get(cache_key, {}).get("etag")) or None
+    if etag_supported is None:
+        etag_supported = response.status_code == 304 or etag is not None
+        log_message("Freshservice %s ETags; conditional requests %s.", 'sends' if etag_supported else 'does not send', 'enabled' if etag_supported else 'disabled')
+    if etag and etag_supported:
+        etag_cache[cache_key] = {"etag": etag, "body": body}; etag_touched.add(cache_key)
+
+def make_api_request(url, headers, params=None, method="GET", retries=MAX_RETRIES, delay=RETRY_DELAY, allow_404=False, allow_403=False, use_etag=False):
+    cache_key = etag_cache_key(url, params) if use_etag and method == "GET" and etag_supported is not False else None
+    cached = etag_cache.get(cache_key) if cache_key else None
+    request_headers = {**headers, "If-None-Match": cached["etag"]} if cached else headers
     current_retry = 0
     while current_retry <= retries:
         try:
-            if method == "GET":
-                response = requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+            response = HTTP_SESSION.request(method, url, headers=request_headers, params=params, timeout=REQUEST_TIMEOUT)
 
+            if response.status_code == 304 and cached:
+                remember_etag(cache_key, response, cached["body"])
+                return cached["body"]
             if response.status_code == 404 and allow_404:
                 return {"error": "404", "status_code": 404, "url": url}
             if response.status_code == 403 and allow_403:
-                log_message(f"Access Denied (403) for URL: {url}. API key may lack permissions for this specific resource.", is_error=True)
-                return {"error": "403", "status_code": 403, "url": url, "body": response.json() if response.content else None}
+                log_message("Access Denied (403) for URL: %s. API key may lack permissions for this specific resource.", url, is_error=True)
+                return {"error": "403", "status_code": 403, "url": url, "body": decode_json(response.content) if response.content else None}
 
             if response.status_code == 429:
                 retry_after = int(response.headers.get('Retry-After', delay))
-                log_message(f"Rate limit. Waiting {retry_after}s. URL: {url}. Attempt {current_retry + 1}/{retries +1}", is_error=True)
+                log_message("Rate limit. Waiting %ss. URL: %s. Attempt %s/%s", retry_after, url, current_retry + 1, retries +1, is_error=True)
                 time.sleep(retry_after)
                 current_retry += 1
                 continue
 
             response.raise_for_status()
-            return response.json()
+            body = decode_json(response.content)
+            if cache_key: remember_etag(cache_key, response, body)
+            return body
 
         except requests.exceptions.Timeout:
-            log_message(f"Timeout: {url}. Attempt {current_retry + 1}/{retries +1}", is_error=True)
+            log_message("Timeout: %s. Attempt %s/%s", url, current_retry + 1, retries +1, is_error=True)
         except requests.exceptions.RequestException as e:
-            log_message(f"Request Exception: {url}: {e}. Attempt {current_retry + 1}/{retries +1}", is_error=True)
+            log_message("Request Exception: %s: %s. Attempt %s/%s", url, e, current_retry + 1, retries +1, is_error=True)
             if hasattr(e, 'response') and e.response is not None:
                 if e.response.status_code == 403 and not allow_403:
-                     log_message(f"Access Denied (403) for URL: {url}. Halting retries for this call.", is_error=True)
-                     log_message(f"Status: 403, Body: {e.response.text[:500]}", is_error=True)
-                     return {"error": "403", "status_code": 403, "url": url, "body": e.response.json() if e.response.content else None}
-                log_message(f"Status: {e.response.status_code}, Body: {e.response.text[:500]}", is_error=True)
+                     log_message("Access Denied (403) for URL: %s. Halting retries for this call.", url, is_error=True)
+                     log_message("Status: 403, Body: %s", e.response.text[:500], is_error=True)
+                     return {"error": "403", "status_code": 403, "url": url, "body": decode_json(e.response.content) if e.response.content else None}
+                log_message("Status: %s, Body: %s", e.response.status_code, e.response.text[:500], is_error=True)
+                if 400 <= e.response.status_code < 500: return None # Client errors won't fix themselves; only 5xx/network errors are retried
         except json.JSONDecodeError:
             response_text_snippet = response.text[:200] if 'response' in locals() and hasattr(response, 'text') else 'N/A'
-            log_message(f"JSON decode error: {url}. Response: {response_text_snippet}", is_error=True)
+            log_message("JSON decode error: %s. Response: %s", url, response_text_snippet, is_error=True)
             return None
 
         current_retry += 1
         if current_retry <= retries:
-            time.sleep(delay)
+            time.sleep(delay * 2 ** (current_retry - 1)) # Exponential backoff: delay, 2*delay, 4*delay...
 
-    log_message(f"Failed: {url} after {retries +1} attempts.", is_error=True)
+    log_message("Failed: %s after %s attempts.", url, retries +1, is_error=True)
     return None
 
 def map_status_id_to_text(status_id):
@@ -105,35 +211,45 @@ def map_priority_id_to_text(priority_id):
     priority_map = {1: "Low", 2: "Medium", 3: "High", 4: "Urgent"}
     return priority_map.get(priority_id, f"Priority ID {priority_id}")
 
+def fetch_page_items(url, headers, key_name, page):
+    time.sleep(DELAY_BETWEEN_SUB_RESOURCE_CALLS)
+    response_data = make_api_request(url, headers, params={'page': page, 'per_page': ITEMS_PER_PAGE})
+    if not response_data or key_name not in response_data:
+        return None
+    return response_data[key_name]
+
 def get_paginated_data(url, headers, key_name):
-    all_items = []
-    page = 1
-    while True:
-        params = {'page': page, 'per_page': ITEMS_PER_PAGE}
-        time.sleep(DELAY_BETWEEN_SUB_RESOURCE_CALLS)
-        response_data = make_api_request(url, headers, params=params)
-        if not response_data or key_name not in response_data:
-            break
-        current_page_items = response_data[key_name]
-        if not current_page_items:
-            break
-        all_items.extend(current_page_items)
-        if len(current_page_items) < ITEMS_PER_PAGE:
-            break
-        page += 1
-        if page > 100:
-            log_message(f"Reached page limit (100) for {key_name} at {url}.", is_error=True)
-            break
+    # Page 1 alone covers most tickets. When it comes back full, the following pages are requested in
+    # concurrent bursts that double in size (2, 4, 8, ...), so K pages cost about log2(K) round trips.
+    first_page_items = fetch_page_items(url, headers, key_name, 1)
+    if not first_page_items:
+        return []
+    all_items = list(first_page_items)
+    if len(first_page_items) < ITEMS_PER_PAGE:
+        return all_items
+    next_page, burst_size = 2, 2
+    with ThreadPoolExecutor(max_workers=MAX_PAGE_BURST) as executor:
+        while next_page <= MAX_SUB_RESOURCE_PAGES:
+            pages = range(next_page, min(next_page + burst_size, MAX_SUB_RESOURCE_PAGES + 1))
+            for page_items in executor.map(lambda page: fetch_page_items(url, headers, key_name, page), pages):
+                if not page_items:
+                    return all_items
+                all_items.extend(page_items)
+                if len(page_items) < ITEMS_PER_PAGE:
+                    return all_items # Any pages past this one in the burst are overshoot and get dropped
+            next_page += len(pages)
+            burst_size = min(burst_size * 2, MAX_PAGE_BURST)
+    log_message("Reached page limit (%s) for %s at %s.", MAX_SUB_RESOURCE_PAGES, key_name, url, is_error=True)
     return all_items
 
 def get_ticket_details_with_includes(base_url, headers, ticket_id):
     url = f"{base_url}/api/v2/tickets/{ticket_id}"
-    valid_includes = "stats,requester,assets,department,requested_for,tags,problem,impacted_services,related_tickets"
+    valid_includes = "stats,requester,assets,department,requested_for,tags,problem,impacted_services,related_tickets,conversations"
     params = {'include': valid_includes}
-    # log_message(f"Fetching details for ticket ID: {ticket_id} with includes: {params['include']}") # Verbose
+    logger.debug("Fetching details for ticket ID: %s with includes: %s", ticket_id, valid_includes)
     response_data = make_api_request(url, headers, params=params)
     if response_data and "ticket" in response_data:
-        ticket_data = response_data["ticket"]
+        ticket_data = dict(response_data["ticket"]) # Copy so enrichment doesn't leak into the ETag cache
 
         raw_status = ticket_data.get('status')
         raw_priority = ticket_data.get('priority')
@@ -142,15 +258,15 @@ def get_ticket_details_with_includes(base_url, headers, ticket_id):
             ticket_data['status_text'] = map_status_id_to_text(raw_status)
         else:
             ticket_data['status_text'] = "Unknown (No Status ID)"
-            log_message(f"Ticket {ticket_id} missing 'status' field for text mapping.", level="WARNING")
+            logger.warning("Ticket %s missing 'status' field for text mapping.", ticket_id)
 
         if raw_priority is not None:
             ticket_data['priority_text'] = map_priority_id_to_text(raw_priority)
         else:
             ticket_data['priority_text'] = "Unknown (No Priority ID)"
-            log_message(f"Ticket {ticket_id} missing 'priority' field for text mapping.", level="WARNING")
+            logger.warning("Ticket %s missing 'priority' field for text mapping.", ticket_id)
         return ticket_data
-    log_message(f"Could not fetch details for ticket ID: {ticket_id} with includes. Response: {response_data}", is_error=True)
+    log_message("Could not fetch details for ticket ID: %s with includes. Response: %s", ticket_id, response_data, is_error=True)
     return None
 
 def get_ticket_conversations(base_url, headers, ticket_id):
@@ -167,74 +283,86 @@ def get_ticket_satisfaction_ratings(base_url, headers, ticket_id):
     response_data = make_api_request(url, headers, allow_404=True)
     if response_data:
         if response_data.get("error") == "404" and response_data.get("status_code") == 404:
-            # log_message(f"No satisfaction ratings found (404) for ticket ID: {ticket_id}.") # Can be verbose
+            logger.debug("No satisfaction ratings found (404) for ticket ID: %s.", ticket_id)
             return []
         if "satisfaction_ratings" in response_data:
             return response_data["satisfaction_ratings"]
         else:
-            log_message(f"Unexpected response structure for satisfaction ratings (ticket {ticket_id}), not a 404: {response_data}", is_error=True)
+            log_message("Unexpected response structure for satisfaction ratings (ticket %s), not a 404: %s", ticket_id, response_data, is_error=True)
             return []
-    log_message(f"Failed to fetch satisfaction ratings for ticket ID: {ticket_id} (all retries exhausted or critical error).", is_error=True)
+    log_message("Failed to fetch satisfaction ratings for ticket ID: %s (all retries exhausted or critical error).", ticket_id, is_error=True)
     return []
 
 def get_client_details(base_url, headers, client_id, entity_type_guess="department"):
-    endpoint_segment = "departments" if entity_type_guess.lower() == "department" else "companies"
-    url = f"{base_url}/api/v2/{endpoint_segment}/{client_id}"
-    log_message(f"Fetching client ('{entity_type_guess}') details for ID: {client_id} from {url}")
-    data = make_api_request(url, headers)
-    key_to_check = entity_type_guess.lower()
-    if data and key_to_check in data:
-        return data[key_to_check], entity_type_guess
-    if entity_type_guess.lower() == "department" and (not data or key_to_check not in data):
-        log_message(f"Could not fetch as '{entity_type_guess}', trying as 'company'.")
-        endpoint_segment = "companies"
-        url = f"{base_url}/api/v2/{endpoint_segment}/{client_id}"
-        data = make_api_request(url, headers)
-        key_to_check = "company"
-        if data and key_to_check in data:
-            log_message("Successfully fetched as 'company'.")
-            return data[key_to_check], "company"
-    log_message(f"Could not fetch client details for ID: {client_id} as '{entity_type_guess}' or 'company'. Response: {data}", is_error=True)
+    # Ask for the ID as both a department and a company at once; a wrong guess no longer costs a second round trip
+    guessed_type = "company" if entity_type_guess.lower() == "company" else "department"
+    entity_types = [guessed_type, "company" if guessed_type == "department" else "department"]
+    endpoints = {"department": "departments", "company": "companies"}
+    log_message("Fetching client details for ID: %s as department and company (guess: '%s')", client_id, entity_type_guess)
+    with ThreadPoolExecutor(max_workers=len(entity_types)) as executor:
+        futures = {entity_type: executor.submit(make_api_request, f"{base_url}/api/v2/{endpoints[entity_type]}/{client_id}", headers, allow_404=True)
+                   for entity_type in entity_types}
+    for entity_type in entity_types:
+        data = futures[entity_type].result()
+        if data and entity_type in data:
+            if entity_type != guessed_type:
+                log_message("Could not fetch as '%s'; successfully fetched as '%s'.", guessed_type, entity_type)
+            return data[entity_type], entity_type
+    log_message("Could not fetch client details for ID: %s as department or company.", client_id, is_error=True)
     return None, None
 
 # Removed get_requester_email function as it's not used due to permissions
 
-def get_tickets_for_client_in_range(base_url, headers, client_id, start_date_str, end_date_str):
-    all_tickets_enriched = []
+def dump_json_line(obj):
+    if orjson: return orjson.dumps(obj) + b"\n"
+    return json.dumps(obj).encode("utf-8") + b"\n"
+
+def get_tickets_for_client_in_range(base_url, headers, client_id, start_date_str, end_date_str, ticket_sink):
+    # Each enriched ticket is written to ticket_sink as one NDJSON line instead of being held in memory
+    tickets_written = 0
     page = 1
     start_dt_iso = start_date_str + "T00:00:00Z"
     end_dt_iso = end_date_str + "T23:59:59Z"
     query = f"(department_id:{client_id}) AND (created_at:>'{start_dt_iso}' AND created_at:<'{end_dt_iso}')"
     filter_url = f"{base_url}/api/v2/tickets/filter"
-    log_message(f"Attempting ticket list with query: {query}")
+    log_message("Attempting ticket list with query: %s", query)
 
     while True:
         params = {'query': f'"{query}"', 'page': page, 'per_page': TICKETS_PER_PAGE}
         # No 'include' here; details are fetched per ticket later
-        response_data = make_api_request(filter_url, headers, params=params)
+        response_data = make_api_request(filter_url, headers, params=params, use_etag=True)
         if not response_data or 'tickets' not in response_data:
-            log_message(f"No more ticket IDs or error fetching page {page} of ID list. Query was: {query}", is_error=not response_data)
+            log_message("No more ticket IDs or error fetching page %s of ID list. Query was: %s", page, query, is_error=not response_data)
             if page == 1 and (not response_data or 'tickets' not in response_data):
-                 log_message(f"Initial query with 'department_id:{client_id}' failed. Check filter criteria.", is_error=True)
+                 log_message("Initial query with 'department_id:%s' failed. Check filter criteria.", client_id, is_error=True)
             break
         current_page_ticket_stubs = response_data['tickets']
-        log_message(f"Fetched {len(current_page_ticket_stubs)} ticket stubs on page {page} using query: {query}.")
+        log_message("Fetched %s ticket stubs on page %s using query: %s.", len(current_page_ticket_stubs), page, query)
         for i, ticket_stub in enumerate(current_page_ticket_stubs):
             ticket_id = ticket_stub.get("id")
             if not ticket_id:
                 log_message("Skipping ticket stub with no ID.", is_error=True)
                 continue
 
-            log_message(f"Processing ticket ID: {ticket_id} ({i+1}/{len(current_page_ticket_stubs)} on this page)")
+            logger.debug("Processing ticket ID: %s (%d/%d on this page)", ticket_id, i+1, len(current_page_ticket_stubs))
             detailed_ticket = get_ticket_details_with_includes(base_url, headers, ticket_id)
             if not detailed_ticket:
-                log_message(f"Skipping ticket ID {ticket_id} due to error fetching its details.", is_error=True)
+                log_message("Skipping ticket ID %s due to error fetching its details.", ticket_id, is_error=True)
                 continue
 
-            detailed_ticket['all_conversations'] = get_ticket_conversations(base_url, headers, ticket_id)
+            # Conversations come back with the detail call; only page through them if the include hit its cap
+            included_conversations = detailed_ticket.pop('conversations', None)
+            if included_conversations is not None and len(included_conversations) < INCLUDED_CONVERSATIONS_LIMIT:
+                detailed_ticket['all_conversations'] = included_conversations
+            else:
+                detailed_ticket['all_conversations'] = get_ticket_conversations(base_url, headers, ticket_id)
             detailed_ticket['all_time_entries'] = get_ticket_time_entries(base_url, headers, ticket_id)
-            detailed_ticket['all_satisfaction_ratings'] = get_ticket_satisfaction_ratings(base_url, headers, ticket_id)
-            all_tickets_enriched.append(detailed_ticket)
+            if detailed_ticket.get('status') in RATEABLE_STATUS_IDS:
+                detailed_ticket['all_satisfaction_ratings'] = get_ticket_satisfaction_ratings(base_url, headers, ticket_id)
+            else:
+                detailed_ticket['all_satisfaction_ratings'] = []
+            ticket_sink.write(dump_json_line(detailed_ticket))
+            tickets_written += 1
             time.sleep(DELAY_BETWEEN_TICKET_PROCESSING_CALLS)
 
         if len(current_page_ticket_stubs) < TICKETS_PER_PAGE:
@@ -245,11 +373,23 @@ def get_tickets_for_client_in_range(base_url, headers, client_id, start_date_str
             log_message("Reached page limit (100) for initial ticket ID list.", is_error=True)
             break
 
-    log_message(f"Total tickets fully processed for client {client_id} in period: {len(all_tickets_enriched)}")
-    return all_tickets_enriched # Now returns only one value (list of tickets)
+    log_message("Total tickets fully processed for client %s in period: %s", client_id, tickets_written)
+    return tickets_written
 
+def write_output_file(output_filepath, client_info, tickets_ndjson_path, ticket_count):
+    # Wrap the NDJSON ticket lines into the single JSON document build_report.py reads
+    summary_stats = {"total_tickets_processed_in_period": ticket_count}
+    with open(output_filepath, 'wb') as out, open(tickets_ndjson_path, 'rb') as tickets_in:
+        out.write(b'{"client_info": ' + dump_json_line(client_info).rstrip() + b', "tickets": [')
+        for i, line in enumerate(tickets_in):
+            if i: out.write(b",\n")
+            out.write(line.rstrip(b"\n"))
+        out.write(b'], "summary_stats": ' + dump_json_line(summary_stats).rstrip() + b'}\n')
 
+
+# Returns (success, message) so main.py can call this in-process as well as via the CLI below
 def main(client_id_to_fetch, client_entity_type_guess="department"):
+    run_started = time.monotonic()
     today = datetime.date.today()
     first_day_current_month = today.replace(day=1)
     last_day_previous_month = first_day_current_month - datetime.timedelta(days=1)
@@ -257,21 +397,19 @@ def main(client_id_to_fetch, client_entity_type_guess="department"):
     start_date_str = first_day_previous_month.strftime("%Y-%m-%d")
     end_date_str = last_day_previous_month.strftime("%Y-%m-%d")
 
-    log_message(f"Starting exploratory data pull for Client ID: {client_id_to_fetch}")
-    log_message(f"Calculated Date Range: {start_date_str} to {end_date_str}")
+    log_message("Starting exploratory data pull for Client ID: %s", client_id_to_fetch)
+    log_message("Calculated Date Range: %s to %s", start_date_str, end_date_str)
 
-    if not os.path.exists(OUTPUT_DIR):
-        try:
-            os.makedirs(OUTPUT_DIR)
-            log_message(f"Created output directory: {OUTPUT_DIR}")
-        except OSError as e:
-            log_message(f"Error creating output dir {OUTPUT_DIR}: {e}", is_error=True)
-            return
+    try:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+    except OSError as e:
+        log_message("Error creating output dir %s: %s", OUTPUT_DIR, e, is_error=True)
+        return False, f"Error creating output dir {OUTPUT_DIR}: {e}"
 
     api_key = read_api_key(TOKEN_FILE)
-    auth_str = f"{api_key}:X"
-    encoded_auth = base64.b64encode(auth_str.encode()).decode()
-    headers = {"Content-Type": "application/json", "Authorization": f"Basic {encoded_auth}"}
+    if not api_key:
+        return False, f"Freshservice token could not be read from {TOKEN_FILE}."
+    headers = build_headers(api_key)
 
     client_details_obj, client_type_found = get_client_details(BASE_URL, headers, client_id_to_fetch, entity_type_guess=client_entity_type_guess)
     client_name = f"Client_{client_id_to_fetch}"
@@ -281,12 +419,12 @@ def main(client_id_to_fetch, client_entity_type_guess="department"):
         "id": client_id_to_fetch, "name": client_name,
         "fetched_as_type": actual_client_entity_type,
         "report_period_start": start_date_str, "report_period_end": end_date_str,
-        "retrieval_date": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        "retrieval_date": datetime.datetime.now(_TZ_UTC).isoformat()
         # Removed contact_email field
     }
 
     if client_details_obj:
-        log_message(f"Successfully fetched client_details for ID {client_id_to_fetch}. Extracting specific fields.")
+        log_message("Successfully fetched client_details for ID %s. Extracting specific fields.", client_id_to_fetch)
         client_name = client_details_obj.get('name', client_name)
         actual_client_entity_type = client_type_found
         client_info_output["name"] = client_name
@@ -300,44 +438,42 @@ def main(client_id_to_fetch, client_entity_type_guess="department"):
         client_info_output['company_head_name'] = client_details_obj.get('head_name')
         client_info_output['prime_user_name'] = client_details_obj.get('prime_user_name')
         # Prime_user_id and head_user_id are still in client_details_obj if needed for other purposes later
-        log_message(f"Extracted client info. Prime User Name: {client_info_output.get('prime_user_name')}, Head Name: {client_info_output.get('company_head_name')}.")
+        log_message("Extracted client info. Prime User Name: %s, Head Name: %s.", client_info_output.get('prime_user_name'), client_info_output.get('company_head_name'))
     else:
-        log_message(f"Could not retrieve client details for ID {client_id_to_fetch}. Client info in output will be minimal.", is_error=True)
+        log_message("Could not retrieve client details for ID %s. Client info in output will be minimal.", client_id_to_fetch, is_error=True)
 
-    tickets_data = get_tickets_for_client_in_range(BASE_URL, headers, client_id_to_fetch, start_date_str, end_date_str)
-
-    if tickets_data is None:
-        log_message(f"Ticket fetching process failed critically for client ID {client_id_to_fetch}.", is_error=True)
-        error_data = { "client_info": client_info_output, "error": "Ticket fetching failed", "tickets": []}
-        output_filename = f"freshservice_{client_id_to_fetch}_ERROR.json"
-        output_filepath = os.path.join(OUTPUT_DIR, output_filename)
-        try:
-            with open(output_filepath, 'w') as f_err: json.dump(error_data, f_err, indent=4)
-        except Exception as e_json:
-            log_message(f"Could not write error JSON: {e_json}", is_error=True)
-        return
-
-    log_message(f"Note: Email fetching for Prime User/Company Head has been removed due to API permission issues.")
-
-    output_data = {
-        "client_info": client_info_output,
-        "tickets": tickets_data,
-        "summary_stats": {"total_tickets_processed_in_period": len(tickets_data) if tickets_data is not None else 0}
-    }
+    # Tickets are streamed to a temporary NDJSON file and folded into the final JSON document at the end
+    tickets_ndjson_path = os.path.join(OUTPUT_DIR, f".freshservice_{client_id_to_fetch}.tickets.ndjson")
     output_filename = f"freshservice_{client_id_to_fetch}.json"
     output_filepath = os.path.join(OUTPUT_DIR, output_filename)
+    success, message = True, f"Wrote detailed data to {output_filepath}"
+    load_etag_cache(client_id_to_fetch, start_date_str)
     try:
-        with open(output_filepath, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=4)
-        log_message(f"Successfully wrote detailed data to {output_filepath}")
+        with open(tickets_ndjson_path, 'wb') as tickets_ndjson:
+            ticket_count = get_tickets_for_client_in_range(BASE_URL, headers, client_id_to_fetch, start_date_str, end_date_str, tickets_ndjson)
+
+        log_message("Note: Email fetching for Prime User/Company Head has been removed due to API permission issues.")
+
+        write_output_file(output_filepath, client_info_output, tickets_ndjson_path, ticket_count)
+        log_message("Successfully wrote detailed data to %s", output_filepath)
     except IOError as e:
-        log_message(f"Error writing data to {output_filepath}: {e}", is_error=True)
+        log_message("Error writing data to %s: %s", output_filepath, e, is_error=True)
+        success, message = False, f"Error writing data to {output_filepath}: {e}"
+    finally:
+        if os.path.exists(tickets_ndjson_path): os.remove(tickets_ndjson_path)
+        save_etag_cache(client_id_to_fetch, start_date_str) # Also empties etag_cache when the pull raised
+    log_message("Data pull for client %s took %.1fs.", client_id_to_fetch, time.monotonic() - run_started)
+    return success, message
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetch detailed Freshservice ticket data for a specific client for the previous full month.")
     parser.add_argument("client_id", type=int, help="The Freshservice Client ID (Company or Department ID).")
     parser.add_argument("--entity_type", type=str, default="department", choices=["department", "company"],
                         help="The entity type Freshservice likely treats this client ID as (default: department).")
+    parser.add_argument("--verbose", action="store_true", help="Also log per-ticket progress.")
+    parser.add_argument("--log-file", help="Also append the log to this file (rotated at 1 MB, 3 backups).")
     args = parser.parse_args()
-    main(args.client_id, args.entity_type)
-    log_message(f"Exploratory data pull for client {args.client_id} finished.")
+    configure_logging(logging.DEBUG if args.verbose else logging.INFO, args.log_file)
+    success, message = main(args.client_id, args.entity_type)
+    log_message("Exploratory data pull for client %s finished: %s", args.client_id, message, is_error=not success)
+    sys.exit(0 if success else 1)
@@ -0,0 +1,29 @@
+# Gunicorn settings for running the dashboard outside Flask's dev server:
+#   gunicorn -c gunicorn_conf.py wsgi:app
+import os
+
+bind = os.environ.get("INTEGOREPORT_BIND", "0.0.0.0:5000")
+
+# --- Workers ---
+# Exactly one worker process: report jobs (main.JOBS / main.EXECUTOR) live in that process's memory,
+# so a /status poll served by a second worker would never find its job.
+workers = 1
+# Request concurrency comes from threads instead. The slow parts (Freshservice/Mailchimp HTTP) release
+# the GIL while waiting, so threads overlap them without monkey-patching the pullers' own thread pools.
+# INTEGOREPORT_WORKER_CLASS=gevent (needs `pip install gevent`) swaps in greenlets for many more idle
+# connections; gunicorn's gevent worker monkey-patches the process itself before loading the app.
+worker_class = os.environ.get("INTEGOREPORT_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("INTEGOREPORT_THREADS", "16"))
+worker_connections = 1000 # gevent only: concurrent greenlets per worker
+
+# Report generation runs off the request thread, but /update_clients still runs the whole client_updater
+# (Freshservice list and detail fetches plus every Mailchimp members page) on the request thread, so the
+# timeout has to cover a full client-list refresh, not just the Mailchimp send. A reverse proxy in front
+# needs a matching read timeout (nginx: proxy_read_timeout).
+timeout = int(os.environ.get("INTEGOREPORT_TIMEOUT", "600"))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+loglevel = "info"
@@ -2,21 +2,36 @@
 
 import json
 import os
+from flask import Flask, render_template, redirect, url_for, jsonify, send_from_directory, flash, request, Response, stream_with_context
+import atexit
+import logging
+import logging.handlers
+import queue
+import re
 import subprocess
 import sys
-from flask import Flask, render_template, redirect, url_for, jsonify, send_file, flash
-import logging
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
+import functools
+import gzip
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from jinja2 import FileSystemBytecodeCache
+try:
+    import orjson # Optional; faster parsing of companies_list.json
+except ImportError:
+    orjson = None
+
+import build_report
+from data_pullers import freshservice
+from utils import client_updater
 
 # --- Configuration ---
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 CLIENT_LIST_FILE = os.path.join(PROJECT_ROOT, "companies_list.json")
-CLIENT_UPDATER_SCRIPT = os.path.join(PROJECT_ROOT, "utils", "client_updater.py")
-FRESHSERVICE_PULLER_SCRIPT = os.path.join(PROJECT_ROOT, "data_pullers", "freshservice.py")
-BUILD_REPORT_SCRIPT = os.path.join(PROJECT_ROOT, "build_report.py")
-OUTPUT_REPORT_FILE = os.path.join(PROJECT_ROOT, "output_report.html")
 TEMPLATES_DIR = os.path.join(PROJECT_ROOT, "templates")
 RAW_DATA_DIR = os.path.join(PROJECT_ROOT, "raw_data")
 FS_TOKEN_FILE = os.path.join(PROJECT_ROOT, "token.txt")
@@ -28,42 +43,126 @@ COPY_REPORT_TO_EMAIL = "david@integotec.com"
 SECRET_KEY = os.urandom(24)
 REQUEST_TIMEOUT = 30
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [flask_app] - %(message)s')
+# Optional hand-off of the report download to a fronting web server, so the bytes go out via its sendfile(2):
+#   INTEGOREPORT_X_ACCEL_PREFIX=/internal/  -> nginx, with `location /internal/ { internal; alias <PROJECT_ROOT>/; }`
+#   INTEGOREPORT_X_SENDFILE=1               -> Apache mod_xsendfile / lighttpd (Flask's use_x_sendfile)
+REPORT_X_ACCEL_PREFIX = os.environ.get("INTEGOREPORT_X_ACCEL_PREFIX")
+USE_X_SENDFILE = os.environ.get("INTEGOREPORT_X_SENDFILE") == "1"
+# Run the updater/puller/builder as child processes instead of in-process calls (crash isolation, at the cost of
+# interpreter start-up per step). `python main.py --isolate`, or INTEGOREPORT_ISOLATE=1 under gunicorn.
+ISOLATE_STEPS = os.environ.get("INTEGOREPORT_ISOLATE") == "1" or "--isolate" in sys.argv[1:]
+# Opt-in: gzip the campaign-content PUT (the whole report HTML, JSON-escaped). Off by default since
+# Mailchimp doesn't document compressed request bodies; enable once verified against your account.
+MAILCHIMP_GZIP_CONTENT = os.environ.get("INTEGOREPORT_MC_GZIP") == "1"
+
+# Report generation runs off the request thread. One job at a time, because the Freshservice puller keeps
+# per-pull state (ETag cache, shared session) at module level. Each client's report goes to its own file.
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+JOBS = {} # job_id -> {"client_id", "future", "stage", "finished_at"}, dropped JOB_RESULT_TTL after finishing
+JOB_RESULT_TTL = 600 # seconds a finished job's result stays readable, so a dropped /events stream can fall back to /status
+JOB_EVENT_INTERVAL = 0.5 # seconds between stage checks in the /events stream
+JOB_EVENT_KEEPALIVE = 15 # seconds; SSE comment line so idle proxies don't drop the stream during a long pull
+
+# Records are handed to a queue and written by a listener thread, so a slow stderr/disk never stalls a request
+# or a report job. Root-level, so the in-process puller/builder loggers share it; %(name)s tells them apart.
+LOG_QUEUE = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - [%(name)s] - %(message)s'))
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, _log_handler)
+_queue_handler = logging.handlers.QueueHandler(LOG_QUEUE)
+_queue_handler.setFormatter(logging.Formatter('%(message)s')) # Only merges args/traceback into the record; the listener's handler adds the prefix
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+LOG_LISTENER.start(); atexit.register(LOG_LISTENER.stop)
+logger = logging.getLogger("flask_app")
 app = Flask(__name__, template_folder=TEMPLATES_DIR)
 app.secret_key = SECRET_KEY
+app.use_x_sendfile = USE_X_SENDFILE
+os.makedirs(build_report.JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(build_report.JINJA_CACHE_DIR) # Skip recompiling templates on restart
+
+# Dashboard templates are compiled once here; views hand the Template objects straight to render_template,
+# which skips the per-request loader lookup and keeps Flask's context processors and flash support.
+PAGE_TEMPLATES = {name: app.jinja_env.get_template(name) for name in ("index.html", "generating.html", "dispatch_report.html")}
+
+def page_template(name):
+    # In debug mode go back through the loader so template edits still show up on refresh
+    return app.jinja_env.get_template(name) if app.debug else PAGE_TEMPLATES[name]
+
+# orjson when installed, stdlib json otherwise. orjson.JSONDecodeError subclasses json.JSONDecodeError,
+# so existing `except json.JSONDecodeError` handlers keep working either way.
+def encode_json(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode('utf-8')
 
-def log_message_flask(message, is_error=False):
-    if is_error: logging.error(message)
-    else: logging.info(message)
+def decode_json(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
 
 def read_token(file_path, service_name="API"):
     try:
         abs_file_path = os.path.abspath(file_path)
         if not os.path.exists(abs_file_path):
-             log_message_flask(f"Error: {service_name} Token file '{abs_file_path}' not found.", is_error=True); return None
+             logger.error("Error: %s Token file '%s' not found.", service_name, abs_file_path); return None
         with open(abs_file_path, 'r') as f: api_key = f.read().strip()
         if not api_key:
-            log_message_flask(f"Error: {service_name} Token file '{abs_file_path}' is empty.", is_error=True); return None
+            logger.error("Error: %s Token file '%s' is empty.", service_name, abs_file_path); return None
         return api_key
     except Exception as e:
-        log_message_flask(f"Error reading {service_name} token file '{abs_file_path}': {e}", is_error=True); return None
+        logger.error("Error reading %s token file '%s': %s", service_name, abs_file_path, e); return None
 
 def get_mailchimp_dc(api_key):
     parts = api_key.split('-')
     if len(parts) == 2: return parts[1]
-    else: log_message_flask("Could not determine Mailchimp DC from API key.", is_error=True); return None
+    else: logger.error("Could not determine Mailchimp DC from API key."); return None
+
+def build_mailchimp_session():
+    # One pooled session for every Mailchimp call, so the create/content/send/delete sequence reuses a single
+    # keep-alive TLS connection. Retries cover idempotent calls only (PUT/DELETE/GET; urllib3's default
+    # allowed_methods): retrying the campaign-create or send POST could duplicate a campaign or an email.
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry))
+    return session
+
+SAFE_NAME_RE = re.compile(r"[^\w\s]") # Anything but letters, digits, underscore and whitespace becomes "_" in campaign titles
+MC_SESSION = build_mailchimp_session() # The API key is read per send, so auth is passed per call
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=1) # Post-send campaign deletes; separate from report jobs
+CAMPAIGN_SENT_POLL_INTERVAL = 2 # seconds
+CAMPAIGN_SENT_POLL_LIMIT = 90 # seconds; a campaign still not "sent" by then is left in place rather than deleted mid-send
+
+def delete_campaign_when_sent(base_mc_url, auth, campaign_id):
+    # Replaces a fixed 15s sleep in the request: poll until Mailchimp reports the campaign as sent, then delete it
+    deadline = time.monotonic() + CAMPAIGN_SENT_POLL_LIMIT
+    status = None
+    while time.monotonic() < deadline:
+        try:
+            response = MC_SESSION.get(f"{base_mc_url}/campaigns/{campaign_id}", auth=auth, params={"fields": "status"}, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            status = decode_json(response.content).get("status")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error("MC campaign status check failed (%s): %s", campaign_id, e)
+        if status == "sent": break
+        time.sleep(CAMPAIGN_SENT_POLL_INTERVAL)
+    else:
+        logger.warning("Mailchimp campaign %s not sent after %ss (last status: %s); leaving it in place.", campaign_id, CAMPAIGN_SENT_POLL_LIMIT, status)
+        return
+    try:
+        logger.info("Deleting MC campaign ID: %s", campaign_id)
+        MC_SESSION.delete(f"{base_mc_url}/campaigns/{campaign_id}", auth=auth, timeout=REQUEST_TIMEOUT).raise_for_status()
+        logger.info("Mailchimp campaign %s deleted successfully.", campaign_id)
+    except requests.exceptions.RequestException as e:
+        response_text = e.response.text if e.response is not None else 'N/A'
+        logger.error("MC delete campaign error (%s): %s. Response: %s", campaign_id, e, response_text)
 
 # *** MODIFIED send_report_via_mailchimp for single campaign ***
 def send_report_via_mailchimp(mc_api_key, mc_dc, list_id, client_email, client_name, report_html_content, copy_to_email_address=None):
     if not all([mc_api_key, mc_dc, list_id, client_email]):
-        log_message_flask("Mailchimp API key, DC, List ID, or client email missing.", is_error=True)
+        logger.error("Mailchimp API key, DC, List ID, or client email missing.")
         return False, "Missing Mailchimp configuration or client email."
 
     base_mc_url = f"https://{mc_dc}.api.mailchimp.com/3.0"
     auth = ('anystring', mc_api_key)
     headers = {'Content-Type': 'application/json'}
 
-    safe_client_name = "".join(c if c.isalnum() or c.isspace() else "_" for c in client_name)
+    safe_client_name = SAFE_NAME_RE.sub("_", client_name)
     timestamp_str = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
 
     campaign_title = f"Monthly Report for {safe_client_name} - {timestamp_str}"
@@ -101,7 +200,7 @@ def send_report_via_mailchimp(mc_api_key, mc_dc, list_id, client_email, client_n
 
     def get_error_response_text(e):
         if hasattr(e, 'response') and e.response is not None:
-            try: return e.response.json()
+            try: return decode_json(e.response.content)
             except json.JSONDecodeError: return e.response.text
         return "No response attribute or response is None."
 
@@ -110,113 +209,171 @@ def send_report_via_mailchimp(mc_api_key, mc_dc, list_id, client_email, client_n
         target_emails_log += f" and {copy_to_email_address}"
 
     try:
-        log_message_flask(f"Creating Mailchimp campaign: {campaign_title} for {target_emails_log}")
-        response = requests.post(f"{base_mc_url}/campaigns", auth=auth, headers=headers, json=campaign_payload, timeout=REQUEST_TIMEOUT)
+        logger.info("Creating Mailchimp campaign: %s for %s", campaign_title, target_emails_log)
+        response = MC_SESSION.post(f"{base_mc_url}/campaigns", auth=auth, headers=headers, data=encode_json(campaign_payload), timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        campaign_id = response.json().get("id")
-        log_message_flask(f"Mailchimp campaign created with ID: {campaign_id} for {target_emails_log}")
+        campaign_id = decode_json(response.content).get("id")
+        logger.info("Mailchimp campaign created with ID: %s for %s", campaign_id, target_emails_log)
     except requests.exceptions.RequestException as e:
         err_msg = f"MC campaign creation error ({target_emails_log}): {e}. Response: {get_error_response_text(e)}"
-        log_message_flask(err_msg, is_error=True)
+        logger.error(err_msg)
         return False, "Failed to create Mailchimp campaign."
     except Exception as e:
-        log_message_flask(f"Unexpected error creating MC campaign ({target_emails_log}): {e}", is_error=True)
+        logger.error("Unexpected error creating MC campaign (%s): %s", target_emails_log, e)
         return False, "Unexpected error creating Mailchimp campaign."
 
     if not campaign_id: return False, "Failed to get campaign ID."
 
     content_payload = {"html": report_html_content}
     try:
-        log_message_flask(f"Setting content for MC campaign ID: {campaign_id}")
-        response = requests.put(f"{base_mc_url}/campaigns/{campaign_id}/content", auth=auth, headers=headers, json=content_payload, timeout=REQUEST_TIMEOUT)
+        logger.info("Setting content for MC campaign ID: %s", campaign_id)
+        content_body, content_headers = encode_json(content_payload), headers
+        if MAILCHIMP_GZIP_CONTENT:
+            content_body = gzip.compress(content_body, compresslevel=6); content_headers = {**headers, 'Content-Encoding': 'gzip'}
+        response = MC_SESSION.put(f"{base_mc_url}/campaigns/{campaign_id}/content", auth=auth, headers=content_headers, data=content_body, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
     except Exception as e:
         err_msg = f"MC set content error ({campaign_id}): {e}. Response: {get_error_response_text(e) if isinstance(e, requests.exceptions.RequestException) else 'N/A'}"
-        log_message_flask(err_msg, is_error=True)
-        if campaign_id: requests.delete(f"{base_mc_url}/campaigns/{campaign_id}", auth=auth, timeout=REQUEST_TIMEOUT)
+        logger.error(err_msg)
+        if campaign_id: MC_SESSION.delete(f"{base_mc_url}/campaigns/{campaign_id}", auth=auth, timeout=REQUEST_TIMEOUT)
         return False, "Failed to set Mailchimp campaign content."
 
     try:
-        log_message_flask(f"Sending MC campaign ID: {campaign_id} to {target_emails_log}")
-        response = requests.post(f"{base_mc_url}/campaigns/{campaign_id}/actions/send", auth=auth, timeout=REQUEST_TIMEOUT)
+        logger.info("Sending MC campaign ID: %s to %s", campaign_id, target_emails_log)
+        response = MC_SESSION.post(f"{base_mc_url}/campaigns/{campaign_id}/actions/send", auth=auth, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        log_message_flask(f"Mailchimp campaign sent successfully to {target_emails_log}.")
+        logger.info("Mailchimp campaign sent successfully to %s.", target_emails_log)
     except Exception as e:
         err_msg = f"MC send campaign error ({campaign_id}): {e}. Response: {get_error_response_text(e) if isinstance(e, requests.exceptions.RequestException) else 'N/A'}"
-        log_message_flask(err_msg, is_error=True)
+        logger.error(err_msg)
         return False, f"Failed to send Mailchimp campaign to {target_emails_log}. Detail: {err_msg}"
 
-    sleep_duration_before_delete = 15
-    log_message_flask(f"Waiting {sleep_duration_before_delete}s before attempting to delete campaign {campaign_id}...")
-    time.sleep(sleep_duration_before_delete)
-
-    try:
-        log_message_flask(f"Deleting MC campaign ID: {campaign_id}")
-        requests.delete(f"{base_mc_url}/campaigns/{campaign_id}", auth=auth, timeout=REQUEST_TIMEOUT).raise_for_status()
-        log_message_flask(f"Mailchimp campaign {campaign_id} deleted successfully.")
-    except Exception as e:
-        log_message_flask(f"MC delete campaign error ({campaign_id}): {e}. Response: {get_error_response_text(e) if isinstance(e, requests.exceptions.RequestException) else 'N/A'}", is_error=True)
+    # Cleanup happens off the request thread; the user gets the result as soon as the send is accepted
+    CLEANUP_EXECUTOR.submit(delete_campaign_when_sent, base_mc_url, auth, campaign_id)
 
     return True, f"Report sent via Mailchimp to {target_emails_log}."
 
 
 # --- Helper Functions ---
-def run_script(script_path, *args):
-    python_executable = sys.executable; command = [python_executable, script_path] + list(args)
-    log_message_flask(f"Running command: {' '.join(command)}")
+def read_json_file(path):
+    with open(path, 'rb') as f: return decode_json(f.read())
+
+def run_script_isolated(step_name, script_path, cli_args):
+    # Fallback for --isolate: run the step's own CLI in a child interpreter. Output is forwarded line by line
+    # as it arrives rather than buffered whole; the child's exit code is the step's success flag. stderr is
+    # merged into the one stdout pipe, so a single reader drains everything and neither pipe can fill and block
+    # the child; the 64 KiB buffer keeps a chatty child from costing a read() syscall per line.
+    command = [sys.executable, script_path, *cli_args]
+    logger.info("Running command: %s", command)
+    last_line = ""
+    try:
+        with subprocess.Popen(command, cwd=PROJECT_ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=65536) as proc:
+            for line in proc.stdout:
+                line = line.rstrip()
+                if line: logger.info("%s: %s", step_name, line); last_line = line
+            returncode = proc.wait()
+    except OSError as e:
+        logger.error("Could not start %s: %s", script_path, e)
+        return False, f"Could not start {step_name}: {e}"
+    if returncode != 0: return False, f"{step_name} exited with code {returncode}: {last_line}"
+    return True, last_line
+
+def run_step(step_name, entrypoint, *args, cli_args=()):
+    # The updater/puller/builder modules are imported once and called directly; their log output goes
+    # straight to this process's handlers instead of being captured from a child interpreter.
+    if ISOLATE_STEPS:
+        success, message = run_script_isolated(step_name, sys.modules[entrypoint.__module__].__file__, cli_args)
+        if not success: logger.error("%s failed: %s", step_name, message)
+        return success, message
+    logger.info("Running %s in-process", step_name)
     try:
-        result = subprocess.run(command, cwd=PROJECT_ROOT, capture_output=True, text=True, check=False)
-        if result.stdout: log_message_flask(f"Script {os.path.basename(script_path)} STDOUT:\n{result.stdout}")
-        if result.returncode != 0:
-            log_message_flask(f"Script {os.path.basename(script_path)} STDERR:\n{result.stderr}",is_error=True)
-            return False, f"Error in {os.path.basename(script_path)}: {result.stderr[:500]}..."
-        return True, "Script executed successfully."
+        success, message = entrypoint(*args)
     except Exception as e:
-        log_message_flask(f"Unexpected error running {script_path}: {e}", is_error=True)
-        return False, f"Unexpected error: {e}"
+        logger.exception("Unexpected error in %s", step_name)
+        return False, f"Unexpected error in {step_name}: {e}"
+    if not success: logger.error("%s failed: %s", step_name, message)
+    return success, message
+
+LINK_STATUS_CLASSES = {"To Add to Mailchimp": "status-to-add", "No FS Contact to Link": "status-no-contact"}
+
+def classify_link_status(client):
+    # (is_linked, css class, display text) for the dashboard's Mailchimp column
+    status = client["mc_link_status"]
+    if client["email"] and "Linked" in status:
+        return True, "status-linked", f"Linked: {client['email']} ({status.replace('Linked (', '').replace(')', '')})"
+    css_class = LINK_STATUS_CLASSES.get(status, "status-not-found")
+    if css_class == "status-to-add": return False, css_class, f"To Add: {client['fs_contact_to_link'] or 'Unknown'}"
+    return False, css_class, status
+
+def normalize_client_list(data):
+    # One validation pass per parse: every client comes out with the same keys and types, so views and
+    # templates can read fields directly instead of guarding each one. Malformed entries are dropped.
+    if not isinstance(data, dict): raise ValueError("top level is not an object")
+    clients = []
+    for raw in data.get("clients") or []:
+        try: client_id = int(raw["id"])
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Skipping client entry without a numeric id: %r", raw); continue
+        clients.append({
+            "id": client_id,
+            "name": str(raw.get("name") or ""),
+            "email": raw.get("email") or None,
+            "mc_link_status": str(raw.get("mc_link_status") or "N/A"),
+            "fs_contact_to_link": raw.get("fs_contact_to_link") or None,
+        })
+        client = clients[-1]
+        client["is_linked"], client["status_class"], client["status_text"] = classify_link_status(client)
+    # by_id shares the client dicts with the list; per-client routes look up in O(1) instead of scanning
+    return {"retrieved_as": str(data.get("retrieved_as") or "Departments"), "clients": clients, "by_id": {c["id"]: c for c in clients}}
+
+@functools.lru_cache(maxsize=4)
+def _load_json_cached(path, mtime_ns):
+    # mtime_ns only keys the cache: rewriting the file (e.g. via update_clients) changes it and forces a reparse
+    return normalize_client_list(read_json_file(path))
+
+def pull_and_build_report(client_id, entity_type, job):
+    job["stage"] = "pulling"
+    success_pull, msg_pull = run_step("freshservice puller", freshservice.main, int(client_id), entity_type, cli_args=(client_id, "--entity_type", entity_type))
+    if not success_pull: return False, f"Data pull failed: {msg_pull}"
+    job["stage"] = "building"
+    success_build, msg_build = run_step("build_report", build_report.main, client_id, cli_args=(client_id,))
+    if not success_build: return False, f"Report build failed: {msg_build}"
+    return True, msg_build
 
 def load_client_data_from_json(client_id_to_find=None):
-    if not os.path.exists(CLIENT_LIST_FILE):
+    try:
+        mtime_ns = os.stat(CLIENT_LIST_FILE).st_mtime_ns
+    except FileNotFoundError:
         return None if client_id_to_find else {"clients": [], "retrieved_as": "Unknown"}
     try:
-        with open(CLIENT_LIST_FILE, 'r', encoding='utf-8') as f: data = json.load(f)
+        data = _load_json_cached(CLIENT_LIST_FILE, mtime_ns)
         if client_id_to_find:
-            for client in data.get("clients", []):
-                if str(client.get("id")) == str(client_id_to_find): return client
-            return None
+            try: return data["by_id"].get(int(client_id_to_find))
+            except ValueError: return None
         return data
     except Exception as e:
-        log_message_flask(f"Error loading {CLIENT_LIST_FILE}: {e}", is_error=True)
+        logger.error("Error loading %s: %s", CLIENT_LIST_FILE, e)
         return None if client_id_to_find else {"clients": [], "retrieved_as": "Unknown"}
 
+SETUP_CHECK_TTL = 10 # seconds; the dashboard is refreshed far more often than token files change
+_setup_cache = [0.0, ()] # [expires_at (monotonic), issues]
+
+def ensure_runtime_dirs():
+    # One-shot at import (covers both `python main.py` and gunicorn) so check_setup() stays a pure read
+    for d in [RAW_DATA_DIR]:
+        if not os.path.isdir(d): os.makedirs(d, exist_ok=True); logger.info("Created `%s` directory.", os.path.basename(d))
+
 def check_setup():
+    now = time.monotonic()
+    if now < _setup_cache[0]: return _setup_cache[1]
     issues = []
-    if not os.path.exists(FS_TOKEN_FILE): issues.append(f"<b>CRITICAL:</b> `token.txt` (FS key) not found.")
-    if not os.path.exists(MC_TOKEN_FILE): issues.append(f"Warning: `mail_token.txt` (MC key) not found. Mailchimp functions will fail.")
-    for d in [TEMPLATES_DIR, RAW_DATA_DIR]:
-        if not os.path.exists(d): os.makedirs(d); issues.append(f"Info: Created `{os.path.basename(d)}` directory.")
-    return issues
-
-def ensure_templates():
-    index_template_path = os.path.join(TEMPLATES_DIR, "index.html")
-    generating_template_path = os.path.join(TEMPLATES_DIR, "generating.html")
-    dispatch_template_path = os.path.join(TEMPLATES_DIR, "dispatch_report.html")
-    index_html = """<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>IntegoReport Dashboard</title><style>body{font-family:sans-serif;margin:20px;background-color:#f4f8fb;}h1,h2{color:#333;} table{border-collapse:collapse;width:100%;margin-bottom:20px;box-shadow: 0 2px 3px rgba(0,0,0,0.1);}th,td{border:1px solid #ddd;padding:10px 12px;text-align:left;} th{background-color:#007bff;color:white;font-weight:bold;}tr:nth-child(even){background-color:#f9f9f9;} tr:hover{background-color:#f1f1f1;}a,button{text-decoration:none;padding:8px 12px;border:none;background-color:#007bff;color:white;border-radius:4px;cursor:pointer;margin-right:5px;transition: background-color 0.2s ease;}a:hover,button:hover{background-color:#0056b3;} .update-btn{background-color:#28a745;}.update-btn:hover{background-color:#218838;}.btn-disabled{background-color:#secondary;color:#6c757d;cursor:not-allowed;opacity:0.65;}.error, .flash.error{color:red;border:1px solid red;padding:10px;margin-bottom:15px;background-color:#ffebee;}.warning{color:darkorange;border:1px solid orange;padding:10px;margin-bottom:15px;background-color:#fff3e0;}.flash.success{color:green;border:1px solid green;padding:10px;margin-bottom:15px;background-color:#e8f5e9;}.status-linked{color:green;} .status-to-add{color:#ff9800;font-weight:bold;}.status-no-contact, .status-not-found{color:#757575;font-style:italic;}</style></head><body><h1>IntegoReport Dashboard</h1>{% with messages = get_flashed_messages(with_categories=true) %}{% if messages %}{% for category, message in messages %}<div class="flash {{ category }}">{{ message }}</div>{% endfor %}{% endif %}{% endwith %}{% if issues %}{% for issue in issues %}<p class="{% if 'CRITICAL' in issue %}error{% elif 'Warning' in issue %}warning{% else %}error{% endif %}">{{ issue | safe }}</p>{% endfor %}{% endif %}<form action="{{ url_for('update_clients') }}" method="post"><button type="submit" class="update-btn">Update Client List</button></form><h2>Client Overview</h2>{% if clients %}<table><thead><tr><th>Client ID</th><th>Client Name</th><th>Mailchimp Link Status</th><th>Action</th></tr></thead><tbody>{% for client in clients %}<tr><td>{{ client.id }}</td><td>{{ client.name }}</td><td>{% set is_linked = client.email and ("Linked" in client.mc_link_status) %}{% if is_linked %}<span class="status-linked">Linked: {{ client.email }} ({{ client.mc_link_status.replace("Linked (", "").replace(")", "") }})</span>{% elif client.mc_link_status == "To Add to Mailchimp" %}<span class="status-to-add">To Add: {{ client.fs_contact_to_link if client.fs_contact_to_link else 'Unknown' }}</span>{% elif client.mc_link_status == "No FS Contact to Link" %}<span class="status-no-contact">No FS Contact to Link</span>{% else %}<span class="status-not-found">{{ client.mc_link_status if client.mc_link_status else 'N/A' }}</span>{% endif %}</td><td>{% if is_linked %}<a href="{{ url_for('generate_report_for_dispatch', client_id=client.id) }}">Generate Report</a>{% else %}<button class="btn-disabled" disabled title="Link to Mailchimp email first">Generate Report</button>{% endif %}</td></tr>{% endfor %}</tbody></table>{% else %}<p>No clients found. Try updating list.</p>{% endif %}</body></html>"""
-    generating_html = """<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>Generating Report...</title><style>body{font-family:sans-serif;margin:20px;text-align:center}h1{color:#333}.spinner{border:8px solid #f3f3f3;border-top:8px solid #3498db;border-radius:50%;width:60px;height:60px;animation:spin 2s linear infinite;margin:20px auto}#status{margin-top:20px;font-weight:bold;color:#555}@keyframes spin{0%{transform:rotate(0deg)}100%{transform:rotate(360deg)}}</style></head><body><h1>Generating Report for Client ID {{ client_id }}</h1><div class="spinner"></div><p id="status">Starting data pull... Please wait.</p><script>const statusElement = document.getElementById('status'); const clientId = {{ client_id }};window.onload = function() {statusElement.textContent = 'Fetching Freshservice data...';fetch(`/execute_report_generation/${clientId}`).then(response => { if (!response.ok) { throw new Error(`HTTP error! status: ${response.status}`); } return response.json(); }).then(data => {if (data.status === 'ok') { statusElement.textContent = 'Report generated! Preparing dispatch...'; window.location.href = data.dispatch_url; } else { statusElement.textContent = `Error: ${data.message}`; statusElement.style.color = 'red'; }}).catch(error => { console.error('Fetch error:', error); statusElement.textContent = `Failed: ${error}`; statusElement.style.color = 'red'; });};</script></body></html>"""
-    dispatch_report_html = """<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>Dispatch Report for {{ client.name if client else 'N/A' }}</title><style>body{font-family:sans-serif;margin:20px;background-color:#f4f8fb;display:flex;flex-direction:column;align-items:center;padding-top:40px;}.card{background-color:white;padding:30px 40px;border-radius:8px;box-shadow:0 4px 15px rgba(0,0,0,0.1);text-align:center;width:100%;max-width:500px;}h1{color:#004a99;margin-bottom:15px;} p{color:#333;margin-bottom:25px;font-size:1.1em;}.actions a, .actions button {display:inline-block;background-color:#007bff;color:white;padding:12px 20px;text-decoration:none;border-radius:5px;margin:10px;font-size:1em;border:none;cursor:pointer;transition:background-color 0.2s ease;}.actions a:hover, .actions button:hover {background-color:#0056b3;}.actions .view-btn{background-color:#6c757d;}.actions .view-btn:hover{background-color:#5a6268;}.back-link{margin-top:30px;color:#007bff;text-decoration:none;font-size:0.9em;}.flash.success{color:green;border:1px solid green;padding:10px;margin-bottom:15px;background-color:#e8f5e9;border-radius:4px;}.flash.error{color:red;border:1px solid red;padding:10px;margin-bottom:15px;background-color:#ffebee;border-radius:4px;}</style></head><body><div class="card">{% with messages = get_flashed_messages(with_categories=true) %}{% if messages %}{% for category, message in messages %}<div class="flash {{ category }}">{{ message }}</div>{% endfor %}{% endif %}{% endwith %}{% if client %}<h1>Report Generated for {{ client.name }}</h1><p>Linked Email: <strong>{{ client.email if client.email else 'N/A (Cannot send email)' }}</strong></p><div class="actions"><form action="{{ url_for('send_report_email', client_id=client.id) }}" method="post" style="display:inline;"><button type="submit" {% if not client.email %}disabled title="No email linked for this client"{% endif %}>Send via Mailchimp</button></form><a href="{{ url_for('view_report_page') }}" target="_blank" class="view-btn">View in Browser</a></div>{% else %}<h1>Error</h1><p>Client details not found.</p>{% endif %}<a href="{{ url_for('index') }}" class="back-link">Back to Client List</a></div></body></html>"""
-    def write_template_if_needed(path, content):
-        write = True;
-        if os.path.exists(path):
-            try:
-                with open(path, 'r', encoding='utf-8') as f_read:
-                    if f_read.read() == content: write = False
-            except Exception as e: logging.warning(f"Error reading template {path}: {e}")
-        if write:
-            with open(path, 'w', encoding='utf-8') as f: f.write(content)
-            log_message_flask(f"Created/Updated template: {path}")
-    write_template_if_needed(index_template_path, index_html)
-    write_template_if_needed(generating_template_path, generating_html)
-    write_template_if_needed(dispatch_template_path, dispatch_report_html)
+    with os.scandir(PROJECT_ROOT) as it: root_entries = {e.name for e in it} # One directory listing instead of a stat per path
+    if os.path.basename(FS_TOKEN_FILE) not in root_entries: issues.append(f"<b>CRITICAL:</b> `token.txt` (FS key) not found.")
+    if os.path.basename(MC_TOKEN_FILE) not in root_entries: issues.append(f"Warning: `mail_token.txt` (MC key) not found. Mailchimp functions will fail.")
+    _setup_cache[0] = now + SETUP_CHECK_TTL; _setup_cache[1] = tuple(issues)
+    return _setup_cache[1]
+
+ensure_runtime_dirs()
 
 # --- Flask Routes ---
 @app.route('/')
@@ -224,40 +381,90 @@ def index():
     issues = check_setup()
     full_data = load_client_data_from_json()
     clients = full_data.get("clients", []) if full_data else []
-    return render_template('index.html', clients=clients, issues=issues)
+    return render_template(page_template('index.html'), clients=clients, issues=issues)
 
 @app.route('/update_clients', methods=['POST'])
 def update_clients():
-    log_message_flask("Attempting to update client list...")
-    success, message = run_script(CLIENT_UPDATER_SCRIPT)
-    if success: flash("Client list updated successfully!", "success")
+    logger.info("Attempting to update client list...")
+    force = request.form.get("force") == "1"
+    success, message = run_step("client_updater", client_updater.main, True, force, cli_args=("--force",) if force else ())
+    if success: flash(message, "success")
     else: flash(f"Client list update failed: {message}", "error")
     return redirect(url_for('index'))
 
 @app.route('/generate_report_for_dispatch/<client_id>')
 def generate_report_for_dispatch(client_id):
-    log_message_flask(f"Showing generation page for client ID: {client_id}")
-    return render_template('generating.html', client_id=client_id)
+    logger.info("Showing generation page for client ID: %s", client_id)
+    return render_template(page_template('generating.html'), client_id=client_id)
 
 @app.route('/execute_report_generation/<client_id>')
 def execute_report_generation(client_id):
-    log_message_flask(f"Executing report generation for client ID: {client_id}...")
+    logger.info("Executing report generation for client ID: %s...", client_id)
     full_client_data_json = load_client_data_from_json()
     entity_type = "department"
     if full_client_data_json and full_client_data_json.get("retrieved_as"):
         retrieved_as = full_client_data_json.get("retrieved_as", "Departments").lower()
         if "companies" in retrieved_as: entity_type = "company"
 
-    script_args = [str(client_id), "--entity_type", entity_type]
-    success_pull, msg_pull = run_script(FRESHSERVICE_PULLER_SCRIPT, *script_args)
-    if not success_pull:
-        return jsonify({"status": "error", "message": f"Data pull failed: {msg_pull}"})
-
-    success_build, msg_build = run_script(BUILD_REPORT_SCRIPT)
-    if not success_build:
-        return jsonify({"status": "error", "message": f"Report build failed: {msg_build}"})
-
-    return jsonify({"status": "ok", "dispatch_url": url_for('dispatch_report', client_id=client_id)})
+    if not str(client_id).isdigit():
+        return jsonify({"status": "error", "message": f"Invalid client ID: {client_id}"})
+    if int(client_id) not in full_client_data_json.get("by_id", {}):
+        return jsonify({"status": "error", "message": f"Client ID {client_id} is not in the client list. Try updating the list."})
+    client_id = str(int(client_id)) # "007" -> "7", so the puller's output file and the builder's lookup agree
+    job_id = uuid.uuid4().hex
+    job = {"client_id": client_id, "stage": "queued"}
+    job["future"] = EXECUTOR.submit(pull_and_build_report, client_id, entity_type, job)
+    job["future"].add_done_callback(lambda _: job.update(finished_at=time.monotonic()))
+    expire_finished_jobs()
+    JOBS[job_id] = job
+    logger.info("Queued report generation job %s for client ID: %s", job_id, client_id)
+    return jsonify({"status": "queued", "job_id": job_id, "status_url": url_for('report_job_status', job_id=job_id),
+                    "events_url": url_for('report_job_events', job_id=job_id)})
+
+def expire_finished_jobs():
+    # Results nobody collected would otherwise stay in JOBS for the life of the process
+    now = time.monotonic()
+    for job_id, job in list(JOBS.items()):
+        if now - job.get("finished_at", now) > JOB_RESULT_TTL: JOBS.pop(job_id, None)
+
+def job_status_payload(job):
+    # Shared by /status and /events; the result stays readable until expire_finished_jobs drops it
+    if not job["future"].done():
+        return {"status": "running", "stage": job["stage"]}
+    success, message = job["future"].result()
+    if not success:
+        return {"status": "error", "message": message}
+    return {"status": "ok", "dispatch_url": url_for('dispatch_report', client_id=job["client_id"])}
+
+@app.route('/status/<job_id>')
+def report_job_status(job_id):
+    expire_finished_jobs()
+    job = JOBS.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": f"Unknown job ID {job_id}."}), 404
+    return jsonify(job_status_payload(job))
+
+@app.route('/events/<job_id>')
+def report_job_events(job_id):
+    # Server-sent events: one message per stage change (queued -> pulling -> building) and a final ok/error
+    # message, instead of the page polling /status on a timer
+    expire_finished_jobs()
+    job = JOBS.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": f"Unknown job ID {job_id}."}), 404
+    def stream():
+        last_stage, last_sent = None, time.monotonic()
+        while True:
+            payload = job_status_payload(job)
+            if payload["status"] != "running" or payload["stage"] != last_stage:
+                yield f"data: {encode_json(payload).decode('utf-8')}\n\n"
+                if payload["status"] != "running": return
+                last_stage, last_sent = payload["stage"], time.monotonic()
+            elif time.monotonic() - last_sent >= JOB_EVENT_KEEPALIVE:
+                yield ": keep-alive\n\n"; last_sent = time.monotonic()
+            time.sleep(JOB_EVENT_INTERVAL)
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/dispatch_report/<client_id>')
 def dispatch_report(client_id):
@@ -265,7 +472,7 @@ def dispatch_report(client_id):
     if not client:
         flash(f"Could not find client details for ID {client_id}.", "error")
         return redirect(url_for('index'))
-    return render_template('dispatch_report.html', client=client)
+    return render_template(page_template('dispatch_report.html'), client=client)
 
 # *** MODIFIED /send_report_email ROUTE for single campaign send ***
 @app.route('/send_report_email/<client_id>', methods=['POST'])
@@ -275,7 +482,8 @@ def send_report_email(client_id):
         flash(f"Cannot send email: No email address linked for client ID {client_id}.", "error")
         return redirect(url_for('dispatch_report', client_id=client_id))
 
-    if not os.path.exists(OUTPUT_REPORT_FILE):
+    report_file = build_report.output_html_file(client['id']) # The list's int ID, however the URL spelled it
+    if not os.path.exists(report_file):
         flash("Error: Report file not found. Please regenerate.", "error")
         return redirect(url_for('dispatch_report', client_id=client_id))
 
@@ -287,8 +495,9 @@ def send_report_email(client_id):
         return redirect(url_for('dispatch_report', client_id=client_id))
 
     try:
-        with open(OUTPUT_REPORT_FILE, 'r', encoding='utf-8') as f:
-            html_content = f.read()
+        # One binary read with a 64 KiB buffer, decoded once; the content PUT then encodes it with encode_json (no second copy via requests' json=)
+        with open(report_file, 'rb', buffering=65536) as f:
+            html_content = f.read().decode('utf-8')
 
         # Determine if a copy needs to be sent and to whom
         copy_email_address = COPY_REPORT_TO_EMAIL if COPY_REPORT_TO_EMAIL and COPY_REPORT_TO_EMAIL != client.get('email') else None
@@ -305,21 +514,27 @@ def send_report_email(client_id):
             flash(f"Failed to send report via Mailchimp: {message}", "error")
 
     except Exception as e:
-        log_message_flask(f"Error preparing to send email via Mailchimp: {e}", is_error=True)
+        logger.error("Error preparing to send email via Mailchimp: %s", e)
         flash(f"An unexpected error occurred: {e}", "error")
 
     return redirect(url_for('dispatch_report', client_id=client_id))
 
-@app.route('/report')
-def view_report_page():
-    if not os.path.exists(OUTPUT_REPORT_FILE):
+@app.route('/report/<int:client_id>')
+def view_report_page(client_id):
+    report_name = os.path.basename(build_report.output_html_file(client_id))
+    if not os.path.exists(os.path.join(PROJECT_ROOT, report_name)):
         flash("Report file not found. Please generate it first.", "error")
         return redirect(url_for('index'))
-    return send_file(OUTPUT_REPORT_FILE, mimetype='text/html')
+    if REPORT_X_ACCEL_PREFIX:
+        # nginx serves the file itself (and handles conditional GET); Python never reads the report bytes
+        response = app.response_class(mimetype='text/html')
+        response.headers['X-Accel-Redirect'] = REPORT_X_ACCEL_PREFIX.rstrip('/') + '/' + report_name
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    # Conditional GET: unchanged reports come back as a bodyless 304; max_age=0 makes the browser revalidate every time
+    return send_from_directory(PROJECT_ROOT, report_name, mimetype='text/html', conditional=True, max_age=0)
 
 # --- Main Execution ---
 if __name__ == '__main__':
-    _ = check_setup()
-    ensure_templates()
-    log_message_flask("Starting Flask application...")
+    logger.info("Starting Flask application...")
     app.run(debug=True, host='0.0.0.0', port=5000)
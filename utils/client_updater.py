@@ -1,13 +1,25 @@
 # integoreport/utils/client_updater.py
 
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 import json
 import os
+import random
 import sys
 import time
 import datetime
 import argparse
+import logging
+import logging.handlers
+import tempfile
+import functools
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson # Optional; faster parsing of API pages and writing of companies_list.json
+except ImportError:
+    orjson = None
 
 # --- Configuration --- (Keep as is)
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -16,60 +28,130 @@ MC_TOKEN_FILE = os.path.join(PROJECT_ROOT, "mail_token.txt")
 FRESHSERVICE_DOMAIN = "integotecllc.freshservice.com"
 BASE_URL = f"https://{FRESHSERVICE_DOMAIN}"
 CLIENT_LIST_OUTPUT_FILE = os.path.join(PROJECT_ROOT, "companies_list.json")
+DETAIL_CACHE_FILE = os.path.join(PROJECT_ROOT, ".client_details_cache.json") # "<entity>:<id>" -> {"updated_at", "data"}
 MAILCHIMP_LIST_ID = "fa1002aff6" # User provided
 
-ITEMS_PER_PAGE = 30
+ITEMS_PER_PAGE = 100 # Freshservice maximum for list endpoints
+MAX_LIST_PAGES = 60 # 6000 clients at 100 per page
+MAX_PAGE_BURST = 8 # Most list pages requested at once
+LINK_FIELDS = ("prime_user_name", "head_name", "domains") # What update_client_list reads beyond id and name
+DETAIL_FETCH_WORKERS = 8 # Per-client detail GETs in flight at once; 429s back off in make_fs_api_request
 MC_MEMBERS_PER_PAGE = 100
+MC_PAGE_WORKERS = 10 # Mailchimp allows 10 simultaneous connections per API key
+MC_MEMBER_FIELDS = "members.email_address,members.merge_fields.FNAME,members.merge_fields.LNAME,total_items"
 MAX_RETRIES = 3
-RETRY_DELAY = 5
+RETRY_DELAY = 5 # Base delay in seconds; doubled on each retry, capped at MAX_RETRY_DELAY, and jittered
+MAX_RETRY_DELAY = 60
 REQUEST_TIMEOUT = 30
+PRETTY_CLIENT_LIST = os.environ.get("INTEGOREPORT_PRETTY_JSON") == "1" # Indent companies_list.json for reading by hand
+CLIENT_LIST_TTL_MINUTES = 60 # A companies_list.json younger than this is reused unless forced
 
 # --- Logging, Token Reading, Mailchimp DC, FS API Request, FS Client Details, Get All FS Clients ---
 # (These functions remain the same as the previous correct version)
-def log_message(message, is_error=False):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    formatted_message = f"[{timestamp}] [client_updater] {message}"
-    stream = sys.stderr if is_error else sys.stdout
-    print(formatted_message, file=stream)
+logger = logging.getLogger("client_updater")
+
+def configure_logging(level=logging.INFO, log_file=None):
+    # Only used when run as a script; in-process runs from main.py log through its handlers
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.ERROR)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.ERROR)
+    handlers = [stdout_handler, stderr_handler]
+    if log_file: handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=1_000_000, backupCount=3, encoding='utf-8'))
+    logging.basicConfig(format="[%(asctime)s] [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S",
+                        level=level, handlers=handlers)
+
+def log_message(message, *args, is_error=False):
+    logger.log(logging.ERROR if is_error else logging.INFO, message, *args)
 
 def read_token(file_path, service_name="API"):
     try:
         abs_file_path = os.path.abspath(file_path)
         if not os.path.exists(abs_file_path):
-             log_message(f"Error: {service_name} Token file '{abs_file_path}' not found.", is_error=True); return None
+             log_message("Error: %s Token file '%s' not found.", service_name, abs_file_path, is_error=True); return None
         with open(abs_file_path, 'r') as f: api_key = f.read().strip()
         if not api_key:
-            log_message(f"Error: {service_name} Token file '{abs_file_path}' is empty.", is_error=True); return None
+            log_message("Error: %s Token file '%s' is empty.", service_name, abs_file_path, is_error=True); return None
         return api_key
     except Exception as e:
-        log_message(f"Error reading {service_name} token file '{abs_file_path}': {e}", is_error=True); return None
+        log_message("Error reading %s token file '%s': %s", service_name, abs_file_path, e, is_error=True); return None
 
 def get_mailchimp_dc(api_key):
     parts = api_key.split('-')
     if len(parts) == 2: return parts[1]
     else: log_message("Could not determine Mailchimp DC from API key.", is_error=True); return None
 
+# orjson when installed, stdlib json otherwise; orjson.JSONDecodeError subclasses json.JSONDecodeError
+def decode_json(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def encode_json(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def encode_json_indented(obj):
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2) if orjson else json.dumps(obj, indent=2).encode('utf-8')
+
+def current_umask():
+    umask = os.umask(0); os.umask(umask)
+    return umask
+
+FILE_MODE = 0o666 & ~current_umask() # What a plain open(path, 'w') would create; NamedTemporaryFile uses 0600
+
+def write_file_atomically(path, payload):
+    # Written to a temp file and swapped in, so readers never see a half-written file
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp", delete=False) as f:
+        try:
+            f.write(payload)
+            os.chmod(f.name, FILE_MODE) # Readable by a dashboard running as another user, like a plain open() would be
+        except BaseException: f.close(); os.remove(f.name); raise
+    try: os.replace(f.name, path)
+    except BaseException: os.remove(f.name); raise
+
+@functools.lru_cache(maxsize=16384)
+def email_domain(email):
+    # Lowercased domain of an MC email, or None; cached since the same addresses are parsed on every in-process refresh
+    at = email.rfind('@')
+    return email[at + 1:].lower().strip() if at >= 0 else None
+
+@functools.lru_cache(maxsize=1)
+def build_fs_headers(api_key):
+    # Encoded once per API key rather than per update run; read-only because the cached mapping is shared
+    encoded_auth = base64.b64encode(f"{api_key}:X".encode()).decode()
+    return MappingProxyType({"Content-Type": "application/json", "Authorization": f"Basic {encoded_auth}"})
+
+def build_http_session():
+    # Shared by every FS and MC call in a run so pages reuse keep-alive TLS connections instead of a new
+    # handshake per request. Pool size covers the concurrent page bursts; retries stay in our own loops.
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PAGE_BURST * 2, max_retries=0))
+    return session
+
+HTTP_SESSION = build_http_session()
+
 def make_fs_api_request(url, headers, params=None, retries=MAX_RETRIES, delay=RETRY_DELAY, allow_404=False):
     current_retry = 0
     while current_retry <= retries:
         try:
-            response = requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+            response = HTTP_SESSION.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
             if response.status_code == 404 and allow_404:
                 return {"error": "404", "status_code": 404, "url": url}
             if response.status_code == 429:
                 retry_after = int(response.headers.get('Retry-After', delay))
-                log_message(f"FS Rate limit. Waiting {retry_after}s.", is_error=True)
-                time.sleep(retry_after); current_retry += 1; continue
+                log_message("FS Rate limit. Waiting %ss.", retry_after, is_error=True)
+                current_retry += 1
+                if current_retry <= retries: time.sleep(retry_after + random.uniform(0, 1)) # Jitter spreads the pool's retries
+                continue
             response.raise_for_status()
-            return response.json()
+            return decode_json(response.content)
         except requests.exceptions.RequestException as e:
             if hasattr(e, 'response') and e.response is not None and e.response.status_code == 404 and allow_404:
                  return {"error": "404", "status_code": 404, "url": url}
-            log_message(f"FS Request Exception: {url}: {e}. Attempt {current_retry + 1}/{retries +1}", is_error=True)
+            log_message("FS Request Exception: %s: %s. Attempt %s/%s", url, e, current_retry + 1, retries +1, is_error=True)
         except json.JSONDecodeError:
-            log_message(f"FS JSON decode error: {url}. Response: {response.text[:200]}", is_error=True); return None
-        current_retry += 1; time.sleep(delay)
-    log_message(f"FS Failed: {url} after {retries +1} attempts.", is_error=True); return None
+            log_message("FS JSON decode error: %s. Response: %s", url, response.text[:200], is_error=True); return None
+        current_retry += 1
+        if current_retry <= retries: time.sleep(min(MAX_RETRY_DELAY, delay * 2 ** (current_retry - 1)) * (0.5 + random.random()))
+    log_message("FS Failed: %s after %s attempts.", url, retries +1, is_error=True); return None
 
 def get_fs_client_details(base_url, headers, client_id, primary_entity_hint):
     primary_endpoint_path, primary_key, fallback_endpoint_path, fallback_key = "", "", "", ""
@@ -86,76 +168,119 @@ def get_fs_client_details(base_url, headers, client_id, primary_entity_hint):
     url_fallback = f"{base_url}/api/v2/{fallback_endpoint_path}"
     data_fallback = make_fs_api_request(url_fallback, headers, allow_404=True)
     if data_fallback and data_fallback.get("error") != "404" and fallback_key in data_fallback:
-        log_message(f"Fetched ID {client_id} as {fallback_key.capitalize()} (using fallback).")
+        logger.debug("Fetched ID %s as %s (using fallback).", client_id, fallback_key.capitalize())
         return data_fallback[fallback_key]
     return None
 
-def get_all_clients_data(base_url, headers):
+def fetch_fs_list_page(url, headers, json_key, page):
+    response_data = make_fs_api_request(url, headers, params={'page': page, 'per_page': ITEMS_PER_PAGE}, allow_404=False)
+    if not response_data or json_key not in response_data: return None
+    return response_data[json_key]
+
+def get_all_fs_stubs(url, headers, json_key, first_page_items):
+    # Page 1 is already in hand. While pages keep coming back full, the following ones are requested in
+    # concurrent bursts that double in size (2, 4, 8), so K list pages cost about log2(K) round trips.
+    all_stubs = list(first_page_items)
+    if len(first_page_items) < ITEMS_PER_PAGE: return all_stubs
+    next_page, burst_size = 2, 2
+    with ThreadPoolExecutor(max_workers=MAX_PAGE_BURST) as executor:
+        while next_page <= MAX_LIST_PAGES:
+            pages = range(next_page, min(next_page + burst_size, MAX_LIST_PAGES + 1))
+            for page_items in executor.map(lambda page: fetch_fs_list_page(url, headers, json_key, page), pages):
+                if not page_items: return all_stubs
+                all_stubs.extend(page_items)
+                if len(page_items) < ITEMS_PER_PAGE: return all_stubs # Later pages in the burst are overshoot
+            next_page += len(pages)
+            burst_size = min(burst_size * 2, MAX_PAGE_BURST)
+    log_message("Max page limit reached.", is_error=True)
+    return all_stubs
+
+# --- FS client detail cache ---
+# A client whose list entry still carries the updated_at seen on the last run reuses that run's details
+def load_detail_cache():
+    try:
+        with open(DETAIL_CACHE_FILE, 'rb') as f: return decode_json(f.read())
+    except FileNotFoundError: return {}
+    except (OSError, ValueError) as e:
+        log_message("Ignoring unreadable detail cache %s: %s", DETAIL_CACHE_FILE, e, is_error=True); return {}
+
+def save_detail_cache(cache):
+    try: write_file_atomically(DETAIL_CACHE_FILE, encode_json(cache))
+    except OSError as e: log_message("Could not write detail cache %s: %s", DETAIL_CACHE_FILE, e, is_error=True)
+
+def get_all_clients_data(base_url, headers, save_cache=True):
     all_items_detailed = []
-    page = 1
     current_listing_entity_type = "Companies"; endpoint_to_try = "/api/v2/companies"; json_key = "companies"
-    params_list = {'page': page, 'per_page': ITEMS_PER_PAGE}
+    params_list = {'page': 1, 'per_page': ITEMS_PER_PAGE}
     list_response_data = make_fs_api_request(f"{base_url}{endpoint_to_try}", headers, params=params_list, allow_404=True)
-    if list_response_data and list_response_data.get("error") == "404" and page == 1:
-        log_message(f"FS Companies list 404. Switching to /api/v2/departments.")
+    if list_response_data and list_response_data.get("error") == "404":
+        log_message("FS Companies list 404. Switching to /api/v2/departments.")
         current_listing_entity_type = "Departments"; endpoint_to_try = "/api/v2/departments"; json_key = "departments"
         list_response_data = make_fs_api_request(f"{base_url}{endpoint_to_try}", headers, params=params_list, allow_404=False)
-    processed_stubs_count = 0
-    while True:
-        if not list_response_data or json_key not in list_response_data: break
-        current_page_items = list_response_data[json_key]
-        processed_stubs_count += len(current_page_items)
-        for item_stub in current_page_items:
-            item_id = item_stub.get("id")
-            if not item_id: continue
-            detailed_item = get_fs_client_details(base_url, headers, item_id, current_listing_entity_type)
+    if not list_response_data or json_key not in list_response_data:
+        log_message("Processed 0 FS stubs. Total FS clients with details: 0"); return all_items_detailed, current_listing_entity_type
+    all_stubs = get_all_fs_stubs(f"{base_url}{endpoint_to_try}", headers, json_key, list_response_data[json_key])
+    log_message("Fetched %s %s stubs.", len(all_stubs), current_listing_entity_type)
+    # An ID listed twice (e.g. pages shifting while the burst was in flight) is fetched and listed once
+    unique_stubs = {}
+    for item_stub in all_stubs:
+        if item_stub.get("id"): unique_stubs.setdefault(item_stub["id"], item_stub)
+    stubs_with_ids = list(unique_stubs.values())
+    detail_cache = load_detail_cache(); fresh_cache = {}; skipped_calls = 0
+    def fetch_details(item_stub):
+        # List entries that already carry every field the linking step reads need no per-client detail call
+        if all(field in item_stub for field in LINK_FIELDS): return item_stub, True
+        cached = detail_cache.get(f"{current_listing_entity_type}:{item_stub['id']}")
+        if cached and item_stub.get("updated_at") and cached.get("updated_at") == item_stub["updated_at"]: return cached["data"], True
+        return get_fs_client_details(base_url, headers, item_stub["id"], current_listing_entity_type), False
+    # Each detail lookup is an independent GET, so they overlap on a small pool; map keeps the listing order
+    with ThreadPoolExecutor(max_workers=DETAIL_FETCH_WORKERS) as executor:
+        for item_stub, (detailed_item, not_fetched) in zip(stubs_with_ids, executor.map(fetch_details, stubs_with_ids)):
+            item_id = item_stub["id"]; skipped_calls += not_fetched
+            if detailed_item and item_stub.get("updated_at") and detailed_item is not item_stub:
+                fresh_cache[f"{current_listing_entity_type}:{item_id}"] = {"updated_at": item_stub["updated_at"], "data": detailed_item}
             if detailed_item:
                 if 'name' not in detailed_item and 'name' in item_stub: detailed_item['name'] = item_stub['name']
                 all_items_detailed.append(detailed_item)
             else: all_items_detailed.append({"id": item_id, "name": item_stub.get("name", f"Unknown ID {item_id}"), "error": "Details fetch failed"})
-            time.sleep(0.05)
-        if len(current_page_items) < ITEMS_PER_PAGE: log_message(f"Last page of {current_listing_entity_type} reached."); break
-        page += 1
-        if page > 200: log_message(f"Max page limit reached.", is_error=True); break
-        params_list = {'page': page, 'per_page': ITEMS_PER_PAGE}
-        list_response_data = make_fs_api_request(f"{base_url}{endpoint_to_try}", headers, params=params_list, allow_404=False)
-    log_message(f"Processed {processed_stubs_count} FS stubs. Total FS clients with details: {len(all_items_detailed)}")
+    if save_cache: save_detail_cache(fresh_cache) # Only clients still listed, so deleted ones age out
+    log_message("Processed %s FS stubs. Total FS clients with details: %s (%s without a detail request).", len(all_stubs), len(all_items_detailed), skipped_calls)
     return all_items_detailed, current_listing_entity_type
 
+def fetch_mc_members_page(url, api_key, offset):
+    params = {"count": MC_MEMBERS_PER_PAGE, "offset": offset, "fields": MC_MEMBER_FIELDS}
+    response = HTTP_SESSION.get(url, params=params, auth=('anystring', api_key), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return decode_json(response.content)
+
 def get_all_mailchimp_contacts_rest(api_key, dc, list_id):
     if not all([api_key, dc, list_id]):
         log_message("MC API key, DC, or List ID missing.", is_error=True); return []
-    all_members = []; offset = 0; total_items = -1
-    fields_to_retrieve = "members.email_address,members.merge_fields.FNAME,members.merge_fields.LNAME,total_items"
-    log_message(f"Starting to fetch all MC contacts from list ID: {list_id}")
-    while True:
-        url = f"https://{dc}.api.mailchimp.com/3.0/lists/{list_id}/members"
-        params = {"count": MC_MEMBERS_PER_PAGE, "offset": offset, "fields": fields_to_retrieve}
-        auth = ('anystring', api_key)
-        try:
-            response = requests.get(url, params=params, auth=auth, timeout=REQUEST_TIMEOUT)
-            response.raise_for_status(); data = response.json()
-            if total_items == -1:
-                total_items = data.get('total_items', 0)
-                log_message(f"Mailchimp list '{list_id}' has {total_items} total members.")
-            members_on_page = data.get('members', [])
-            if not members_on_page: break
-            for member in members_on_page:
-                all_members.append({
-                    "email": member.get("email_address","").lower(),
-                    "fname": member.get("merge_fields", {}).get("FNAME", ""),
-                    "lname": member.get("merge_fields", {}).get("LNAME", "")
-                })
-            offset += len(members_on_page)
-            if offset >= total_items: break
-            time.sleep(0.05)
-        except requests.exceptions.RequestException as e:
-            log_message(f"MC REST error fetching members: {e}", is_error=True)
-            if hasattr(e, 'response') and e.response is not None: log_message(f"MC Response: {e.response.text[:200]}", is_error=True)
-            return all_members
-        except json.JSONDecodeError:
-            log_message(f"MC REST JSON decode error.", is_error=True); return all_members
-    log_message(f"Fetched {len(all_members)} Mailchimp contacts.")
+    all_members = []; pages = []
+    url = f"https://{dc}.api.mailchimp.com/3.0/lists/{list_id}/members"
+    log_message("Starting to fetch all MC contacts from list ID: %s", list_id)
+    try:
+        # Page 1 gives total_items, so every remaining offset is known up front and can be requested at once
+        pages.append(fetch_mc_members_page(url, api_key, 0))
+        total_items = pages[0].get('total_items', 0)
+        log_message("Mailchimp list '%s' has %s total members.", list_id, total_items)
+        offsets = range(MC_MEMBERS_PER_PAGE, total_items, MC_MEMBERS_PER_PAGE)
+        if offsets:
+            with ThreadPoolExecutor(max_workers=min(MC_PAGE_WORKERS, len(offsets))) as executor:
+                pages.extend(executor.map(lambda offset: fetch_mc_members_page(url, api_key, offset), offsets))
+    except requests.exceptions.RequestException as e:
+        log_message("MC REST error fetching members: %s", e, is_error=True)
+        if hasattr(e, 'response') and e.response is not None: log_message("MC Response: %s", e.response.text[:200], is_error=True)
+    except json.JSONDecodeError:
+        log_message("MC REST JSON decode error.", is_error=True)
+    for data in pages: # In offset order; after an error this is the pages that arrived before it
+        for member in data.get('members', []):
+            all_members.append({
+                "email": member.get("email_address","").lower(),
+                "fname": member.get("merge_fields", {}).get("FNAME", ""),
+                "lname": member.get("merge_fields", {}).get("LNAME", "")
+            })
+    log_message("Fetched %s Mailchimp contacts.", len(all_members))
     return all_members
 
 # *** MODIFIED update_client_list ***
@@ -165,6 +290,7 @@ def update_client_list(output_to_file=True):
     mc_dc = get_mailchimp_dc(mc_api_key) if mc_api_key else None
     all_mc_contacts_list = [] # List of MC contact dicts
     mc_contacts_lookup = {}   # For faster name/email lookups: key -> email_string
+    mc_domain_lookup = {}     # email domain -> (list position, contact) of the first MC contact on that domain
 
     if mc_api_key and mc_dc:
         if MAILCHIMP_LIST_ID == "YOUR_MAILCHIMP_LIST_ID_HERE":
@@ -178,15 +304,17 @@ def update_client_list(output_to_file=True):
                 full_name = f"{contact.get('fname','')} {contact.get('lname','')} ".lower().strip() # Extra space for single names
                 if full_name and full_name not in mc_contacts_lookup :
                     mc_contacts_lookup[full_name] = contact['email']
+            for position, contact in enumerate(all_mc_contacts_list):
+                mc_domain = email_domain(contact.get('email', ""))
+                if mc_domain: mc_domain_lookup.setdefault(mc_domain, (position, contact))
     else:
         log_message("Mailchimp API key or DC missing. Skipping MC fetch.")
 
     fs_api_key = read_token(FS_TOKEN_FILE, "Freshservice")
     if not fs_api_key: log_message("FS key missing.", is_error=True); return None
-    auth_str = f"{fs_api_key}:X"; encoded_auth = base64.b64encode(auth_str.encode()).decode()
-    headers = {"Content-Type": "application/json", "Authorization": f"Basic {encoded_auth}"}
+    headers = build_fs_headers(fs_api_key)
 
-    client_data, actual_entity_type_name = get_all_clients_data(BASE_URL, headers)
+    client_data, actual_entity_type_name = get_all_clients_data(BASE_URL, headers, save_cache=output_to_file) # --no-file runs leave nothing on disk
     if not client_data: log_message("FS data fetch failed.", is_error=True); return None
 
     client_list_for_ui = []
@@ -200,46 +328,25 @@ def update_client_list(output_to_file=True):
         fs_contact_to_link = None # Name of FS contact we tried to link
 
         if not (item_id and fs_client_name):
-            log_message(f"Skipping FS client due to missing ID or Name: {item.get('id', 'N/A')}", is_error=True); continue
+            log_message("Skipping FS client due to missing ID or Name: %s", item_id or 'N/A', is_error=True); continue
 
-        fs_prime_name = item.get('prime_user_name')
-        fs_head_name = item.get('head_name')
-
-        # Determine the primary FS contact name to search for
-        if fs_prime_name and fs_prime_name.strip():
-            fs_contact_to_link = fs_prime_name.strip()
+        # Prime user first, then head; when neither is in MC, the last name tried is the one reported as missing
+        name_candidates = [(name.strip(), tag) for name, tag in ((item.get('prime_user_name'), "Prime Name"), (item.get('head_name'), "Head Name")) if name and name.strip()]
+        for fs_contact_to_link, tag in name_candidates:
             found_mc_email = mc_contacts_lookup.get(fs_contact_to_link.lower())
-            if found_mc_email: link_status = "Linked (Prime Name)"
-
-        if not found_mc_email and fs_head_name and fs_head_name.strip():
-            fs_contact_to_link = fs_head_name.strip() # This might overwrite fs_contact_to_link if prime was also set
-            if not fs_prime_name or not fs_prime_name.strip(): # If prime_name was empty, head_name is primary target
-                 fs_contact_to_link = fs_head_name.strip()
-
-            found_mc_email = mc_contacts_lookup.get(fs_head_name.lower().strip())
-            if found_mc_email: link_status = "Linked (Head Name)"
-
-        if not fs_contact_to_link and (fs_prime_name or fs_head_name): # Handle cases where one might be just spaces
-            fs_contact_to_link = (fs_prime_name if fs_prime_name and fs_prime_name.strip() else fs_head_name).strip()
-
+            if found_mc_email: link_status = f"Linked ({tag})"; break
 
         # Fallback to domain matching if no name match
-        if not found_mc_email:
-            fs_domains = item.get('domains', [])
-            if fs_domains:
-                normalized_fs_domains = [d.lower().strip() for d in fs_domains if d]
-                for mc_contact in all_mc_contacts_list: # Iterate the original list for domain check
-                    mc_email_val = mc_contact.get('email')
-                    if mc_email_val:
-                        try:
-                            mc_domain = mc_email_val.split('@')[1].lower().strip()
-                            if mc_domain in normalized_fs_domains:
-                                found_mc_email = mc_email_val
-                                link_status = f"Linked (Domain: {mc_domain})"
-                                mc_name_for_log = f"{mc_contact.get('fname','')} {mc_contact.get('lname','')} ".strip()
-                                log_message(f"Linked {fs_client_name} to MC email {found_mc_email} via domain. (MC Contact: {mc_name_for_log or 'N/A'})")
-                                break
-                        except IndexError: continue
+        if not found_mc_email and mc_domain_lookup: # Empty when the MC fetch was skipped, so there is nothing to scan
+            normalized_fs_domains = (d.lower().strip() for d in item.get('domains') or () if d)
+            # Earliest MC contact on any of the client's domains, as the old scan of the whole list picked
+            domain_hits = [hit for hit in map(mc_domain_lookup.get, normalized_fs_domains) if hit]
+            if domain_hits:
+                _, mc_contact = min(domain_hits, key=lambda hit: hit[0])
+                found_mc_email = mc_contact['email']
+                link_status = f"Linked (Domain: {email_domain(found_mc_email)})"
+                mc_name_for_log = f"{mc_contact.get('fname','')} {mc_contact.get('lname','')} ".strip()
+                log_message("Linked %s to MC email %s via domain. (MC Contact: %s)", fs_client_name, found_mc_email, mc_name_for_log or 'N/A')
 
         if found_mc_email:
             linked_count += 1
@@ -263,36 +370,70 @@ def update_client_list(output_to_file=True):
 
     if output_to_file:
         try:
-            with open(CLIENT_LIST_OUTPUT_FILE, 'w', encoding='utf-8') as f:
-                json.dump({"retrieval_date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                           "retrieved_as": actual_entity_type_name, "clients": client_list_for_ui}, f, indent=4)
-            log_message(f"Wrote client list to {CLIENT_LIST_OUTPUT_FILE}")
-        except IOError as e: log_message(f"Error writing file: {e}", is_error=True); return None
+            encode = encode_json_indented if PRETTY_CLIENT_LIST else encode_json
+            payload = encode({"retrieval_date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                              "retrieved_as": actual_entity_type_name, "clients": client_list_for_ui})
+            write_file_atomically(CLIENT_LIST_OUTPUT_FILE, payload) # The dashboard never reads a half-written list
+            log_message("Wrote client list to %s", CLIENT_LIST_OUTPUT_FILE)
+        except IOError as e:
+            log_message("Error writing file: %s", e, is_error=True)
+            return None
 
-    log_message(f"Update finished. {len(client_list_for_ui)} clients processed. {linked_count} linked to Mailchimp.")
+    log_message("Update finished. %s clients processed. %s linked to Mailchimp.", len(client_list_for_ui), linked_count)
     if fs_contacts_to_add_to_mc_log:
-        log_message("\n--- Freshservice Contacts Not Found in Mailchimp (Consider Adding): ---")
-        for contact_info in fs_contacts_to_add_to_mc_log:
-            log_message(f"  Contact Name: {contact_info['fs_contact_name']}, Company: {contact_info['fs_company_name']} (ID: {contact_info['fs_company_id']})")
+        # One record for the whole report rather than one handler write per contact
+        log_message("\n--- Freshservice Contacts Not Found in Mailchimp (Consider Adding): ---\n%s", "\n".join(
+            f"  Contact Name: {contact_info['fs_contact_name']}, Company: {contact_info['fs_company_name']} (ID: {contact_info['fs_company_id']})"
+            for contact_info in fs_contacts_to_add_to_mc_log))
     else:
         log_message("All relevant Freshservice contacts (with prime/head names) were found in Mailchimp or had no name to search for.")
 
     return client_list_for_ui
 
+def load_fresh_client_list(max_age_minutes=CLIENT_LIST_TTL_MINUTES):
+    # The clients from the existing companies_list.json if it was written less than max_age ago, else None
+    try:
+        with open(CLIENT_LIST_OUTPUT_FILE, 'rb') as f: data = decode_json(f.read())
+        age = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(data["retrieval_date"])
+    except (OSError, ValueError, KeyError, TypeError): return None
+    if not datetime.timedelta(0) <= age < datetime.timedelta(minutes=max_age_minutes): return None
+    return data.get("clients")
+
+def main(output_to_file=True, force=False): # (success, message) wrapper used by main.py's in-process call
+    if output_to_file and not force:
+        cached_clients = load_fresh_client_list()
+        if cached_clients is not None:
+            log_message("%s is less than %s minutes old; skipping refetch (force to override).", CLIENT_LIST_OUTPUT_FILE, CLIENT_LIST_TTL_MINUTES)
+            return True, f"Client list is less than {CLIENT_LIST_TTL_MINUTES} minutes old; kept the current {len(cached_clients)} clients. Force a full refresh to refetch."
+    clients = update_client_list(output_to_file=output_to_file)
+    if clients is None: return False, "Client list update failed; see log for details."
+    return True, f"Client list updated: {len(clients)} clients."
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetch FS clients & link via MC REST API.")
     parser.add_argument("--no-file", action="store_true", help="Print only.")
+    parser.add_argument("--log-file", help="Also append the log to this file (rotated at 1 MB, 3 backups).")
+    parser.add_argument("--verbose", action="store_true", help="Also log per-client detail lookups.")
+    parser.add_argument("--force", action="store_true", help=f"Refetch even if companies_list.json is less than {CLIENT_LIST_TTL_MINUTES} minutes old.")
     args = parser.parse_args()
-    clients = update_client_list(output_to_file=not args.no_file)
+    configure_logging(logging.DEBUG if args.verbose else logging.INFO, args.log_file)
+    if not args.no_file:
+        success, message = main(force=args.force)
+        log_message(message, is_error=not success)
+        sys.exit(0 if success else 1)
+    clients = update_client_list(output_to_file=False)
     # Console output for "to add" is handled within update_client_list now.
     # If --no-file, we might want to print the full list if not too long.
-    if clients and args.no_file:
+    if clients:
         log_message("\n--- Client List Summary (Not Saved to File) ---")
+        summary_lines = []
         for c in clients:
             email_info = c.get('email') if c.get('email') else c.get('mc_link_status', 'N/A')
             if c.get('mc_link_status') == "To Add to Mailchimp" and c.get('fs_contact_to_link'):
                 email_info = f"To Add: {c['fs_contact_to_link']}"
-            print(f"  ID: {c['id']}, Name: {c['name']}, Link Status/Email: {email_info}")
+            summary_lines.append(f"  ID: {c['id']}, Name: {c['name']}, Link Status/Email: {email_info}\n")
+        sys.stdout.writelines(summary_lines); sys.stdout.flush() # One buffered write instead of a print per client
 
-    elif not clients and args.no_file:
+    elif not clients:
          log_message("Client list update failed.", is_error=True)
+    sys.exit(0 if clients is not None else 1)
@@ -0,0 +1,6 @@
+# integoreport/wsgi.py
+# WSGI entry point for production servers: gunicorn -c gunicorn_conf.py wsgi:app
+
+from main import app
+
+__all__ = ["app"]